@@ -0,0 +1,289 @@
+from __future__ import print_function
+import os
+import json
+import time
+import hashlib
+import tempfile
+import numpy as np
+
+from Profiling import profiled
+from Compat import loadPickle, dumpsPickle
+
+ArtifactSaveDir = "Artifact-save"
+
+# Source files whose code produces each kind of artifact.  Editing one of
+# them changes the code version of the kind, so older entries become stale.
+ArtifactSources = { "ETM": ["ExtremeTraffic.py"],
+                    "ETMOrbits": ["ExtremeTraffic.py"],
+                    "PrunedETM": ["ExtremeTraffic.py"],
+                    "Wiring": ["Wiring.py", "ExtremeTraffic.py", "Solver.py"],
+                    "RepLinkFP": ["LinkFailurePattern.py", "FailureMask.py", "Topology.py"],
+                    "Hash": ["CompactHash.py", "Solver.py", "Topology.py", "Compat.py"] }
+
+
+def codeVersion(kind, srcDir=None):
+    h = hashlib.sha1()
+    if srcDir is None:
+        srcDir = os.path.dirname(os.path.abspath(__file__))
+    for fname in ArtifactSources[kind]:
+        fp = open(os.path.join(srcDir, fname), "rb")
+        h.update(fname.encode())
+        h.update(fp.read())
+        fp.close()
+    return h.hexdigest()
+
+
+# JSON-able canonical form of stage inputs; arrays are replaced by a digest
+def canonicalInputs(obj):
+    if isinstance(obj, np.ndarray):
+        arr = np.ascontiguousarray(obj)
+        return { "array": hashlib.sha1(str((arr.dtype.str, arr.shape)).encode() + arr.tobytes()).hexdigest() }
+    if isinstance(obj, dict):
+        return dict((str(k), canonicalInputs(v)) for (k, v) in obj.items())
+    if isinstance(obj, (set, frozenset)):
+        return sorted([canonicalInputs(v) for v in obj], key=json.dumps)
+    if isinstance(obj, (list, tuple)):
+        return [canonicalInputs(v) for v in obj]
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return obj
+
+
+def digest(obj):
+    return hashlib.sha1(json.dumps(obj, sort_keys=True).encode()).hexdigest()
+
+
+# Content-addressed store of stage results.  An artifact is keyed by a hash
+# of its kind, its inputs, the code version of its kind and the keys of the
+# artifacts it was computed from, and saved as <kind>/<key>.pkl with a
+# <key>.json record of what produced it.  Files are written to a temporary
+# name and renamed, so readers never see a partial artifact.
+# srcDir is where the ArtifactSources are read, by default next to this file.
+class ArtifactStore():
+    def __init__(self, root=None, srcDir=None):
+        if root is None:
+            root = ArtifactSaveDir
+        self.root = root
+        self.srcDir = srcDir
+        self.versions = dict()
+
+
+    def codeVersion(self, kind):
+        if kind not in self.versions:
+            self.versions[kind] = codeVersion(kind, self.srcDir)
+        return self.versions[kind]
+
+
+    def key(self, kind, inputs, deps=()):
+        return digest({ "kind": kind,
+                        "inputs": canonicalInputs(inputs),
+                        "version": self.codeVersion(kind),
+                        "deps": list(deps) })
+
+
+    def path(self, kind, key):
+        return os.path.join(self.root, kind, key)
+
+
+    def has(self, kind, inputs, deps=()):
+        return os.path.exists(self.path(kind, self.key(kind, inputs, deps)) + ".pkl")
+
+
+    def load(self, kind, inputs, deps=()):
+        return self.loadKey(kind, self.key(kind, inputs, deps))
+
+
+    @profiled("ArtifactStore.loadKey")
+    def loadKey(self, kind, key):
+        fullpath = self.path(kind, key) + ".pkl"
+        if not os.path.exists(fullpath):
+            return None
+        return loadPickle(fullpath)
+
+
+    @profiled("ArtifactStore.save")
+    def save(self, kind, inputs, obj, deps=(), meta=None):
+        key = self.key(kind, inputs, deps)
+        record = { "kind": kind,
+                   "key": key,
+                   "inputs": canonicalInputs(inputs),
+                   "inputsDigest": digest(canonicalInputs(inputs)),
+                   "version": self.codeVersion(kind),
+                   "deps": [list(d) for d in deps],
+                   "created": time.time(),
+                   "meta": meta or dict() }
+        self.writeAtomic(kind, key + ".pkl", dumpsPickle(obj))
+        self.writeAtomic(kind, key + ".json", json.dumps(record, sort_keys=True).encode())
+        return key
+
+
+    def writeAtomic(self, kind, fname, data):
+        kindDir = os.path.join(self.root, kind)
+        if not os.path.isdir(kindDir):
+            os.makedirs(kindDir)
+        (fd, tmppath) = tempfile.mkstemp(dir=kindDir, prefix=".tmp-")
+        try:
+            os.write(fd, data)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.rename(tmppath, os.path.join(kindDir, fname))
+
+
+    # Look up before computing: compute() only runs on a miss.  deps are
+    # (kind, key) pairs of the artifacts the result is computed from.
+    def getOrCompute(self, kind, inputs, compute, deps=()):
+        key = self.key(kind, inputs, deps)
+        obj = self.loadKey(kind, key)
+        if obj is not None:
+            return (obj, key)
+        t = time.time()
+        obj = compute()
+        self.save(kind, inputs, obj, deps, { "time": time.time() - t })
+        return (obj, key)
+
+
+    def records(self, kind=None):
+        if kind is None:
+            kinds = sorted(ArtifactSources.keys())
+        else:
+            kinds = [kind]
+        for k in kinds:
+            kindDir = os.path.join(self.root, k)
+            if not os.path.isdir(kindDir):
+                continue
+            for fname in sorted(os.listdir(kindDir)):
+                if not fname.endswith(".json"):
+                    continue
+                fp = open(os.path.join(kindDir, fname), "r")
+                yield json.load(fp)
+                fp.close()
+
+
+    # Entries produced by another code version of their kind, or computed
+    # from an artifact that is itself stale or gone
+    def staleEntries(self, kind=None):
+        status = dict() # key = (kind, key), value = True when stale
+        allRecords = dict(((r["kind"], r["key"]), r) for r in self.records())
+
+        def isStale(kind, key):
+            if (kind, key) in status:
+                return status[kind, key]
+            status[kind, key] = True
+            record = allRecords.get((kind, key), None)
+            if record is None or record["version"] != self.codeVersion(kind):
+                return True
+            for (depKind, depKey) in record["deps"]:
+                if isStale(depKind, depKey):
+                    return True
+            status[kind, key] = False
+            return False
+
+        return [r for r in self.records(kind) if isStale(r["kind"], r["key"])]
+
+
+    def removeStale(self, kind=None):
+        stale = self.staleEntries(kind)
+        for record in stale:
+            for ext in (".pkl", ".json"):
+                fullpath = self.path(record["kind"], record["key"]) + ext
+                if os.path.exists(fullpath):
+                    os.remove(fullpath)
+        return len(stale)
+
+
+# Pipeline stages through the store.  Each returns (artifact, key) and
+# passes its key on as a dependency of the next stage.
+def storedETM(store, M):
+    from ExtremeTraffic import computeETM
+    return store.getOrCompute("ETM", { "M": M }, lambda: computeETM(M))
+
+
+# Only the orbit representatives under permutations of equal trunks, e.g.
+# for (10, 10, 10, 20), expanded on demand with expandETMOrbits.  The orbit
+# path runs whatever computeETM would pick for M.
+def storedETMOrbits(store, M):
+    from ExtremeTraffic import computeETMOrbits
+    return store.getOrCompute("ETMOrbits", { "M": M }, lambda: computeETMOrbits(M))
+
+
+def storedPrunedETM(store, M, consumer):
+    from ExtremeTraffic import pruneETM
+    (etms, etmKey) = storedETM(store, M)
+    return store.getOrCompute("PrunedETM", { "M": M, "consumer": consumer },
+                              lambda: pruneETM(etms, consumer)[0], [("ETM", etmKey)])
+
+
+def storedWiring(store, radix, M, algo):
+    from Wiring import optimizeWiring, getBaselineWiring
+    from ExtremeTraffic import etmInequalities
+    inputs = { "radix": radix, "M": M, "algo": algo }
+    if algo == "Baseline":
+        return store.getOrCompute("Wiring", inputs, lambda: getBaselineWiring(radix, M))
+    # The cutting-plane mode finds its own ETMs over the ETM polytope and
+    # skips the vertex enumeration, so it is keyed on the polytope instead
+    # of an ETM artifact
+    if algo == "Lazy":
+        inputs["polytope"] = np.array(etmInequalities(M))
+        return store.getOrCompute("Wiring", inputs, lambda: optimizeWiring(radix, M, algo))
+    # Every other algorithm, Heuristic included, solves over the pruned ETMs
+    (etms, etmKey) = storedPrunedETM(store, M, "Wiring")
+    return store.getOrCompute("Wiring", inputs, lambda: optimizeWiring(radix, M, algo, etms=etms),
+                              [("PrunedETM", etmKey)])
+
+
+def storedRepLinkFP(store, radix, M, numFailure, algo):
+    from LinkFailurePattern import FailurePattern, IntFPtoStrFP
+    (wiring, wiringKey) = storedWiring(store, radix, M, algo)
+    compute = lambda: set(IntFPtoStrFP(fp) for fp in FailurePattern(radix, wiring).iterCanonicalIDs(numFailure))
+    return store.getOrCompute("RepLinkFP", { "radix": radix, "M": M, "algo": algo, "numFailure": numFailure },
+                              compute, [("Wiring", wiringKey)])
+
+
+def storedHashResult(store, radix, M, algo, algoHash, lkfp, effCap):
+    from CompactHash import computeCompactHash
+    (wiring, wiringKey) = storedWiring(store, radix, M, algo)
+    (etms, etmKey) = storedPrunedETM(store, M, "Hash")
+    inputs = { "radix": radix, "M": M, "algo": algo, "algoHash": algoHash,
+               "lkfp": sorted(lkfp), "effCap": effCap }
+    compute = lambda: computeCompactHash(radix, M, algo, algoHash, lkfp, effCap, wiring, etms)
+    return store.getOrCompute("Hash", inputs, compute, [("Wiring", wiringKey), ("PrunedETM", etmKey)])
+
+
+def test_ArtifactStore():
+    import shutil
+    srcDir = os.path.dirname(os.path.abspath(__file__))
+    tmpdir = tempfile.mkdtemp()
+    tmpSrc = os.path.join(tmpdir, "src")
+    root = os.path.join(tmpdir, "store")
+    os.makedirs(tmpSrc)
+    for fname in set(f for srcs in ArtifactSources.values() for f in srcs):
+        shutil.copy(os.path.join(srcDir, fname), tmpSrc)
+
+    def fill():
+        store = ArtifactStore(root, tmpSrc)
+        (wiring, wiringKey) = store.getOrCompute("Wiring", { "radix": 4, "M": (2, 2, 4), "algo": "Optimal" },
+                                                 lambda: ((0, 1, 1), (0, 1, 1), (1, 0, 1), (1, 0, 1)))
+        store.getOrCompute("RepLinkFP", { "radix": 4, "M": (2, 2, 4), "algo": "Optimal", "numFailure": 0 },
+                           lambda: set([()]), [("Wiring", wiringKey)])
+        assert len(store.staleEntries()) == 0
+
+    def edit(fname):
+        fp = open(os.path.join(tmpSrc, fname), "a")
+        fp.write("\n# edited\n")
+        fp.close()
+        return sorted(r["kind"] for r in ArtifactStore(root, tmpSrc).staleEntries())
+
+    # A dependency of a kind, not only its own module, versions its entries,
+    # and staleness carries on to the entries computed from them
+    fill()
+    assert edit("ExtremeTraffic.py") == ["RepLinkFP", "Wiring"]
+    assert ArtifactStore(root, tmpSrc).removeStale() == 2
+    fill()
+    assert edit("FailureMask.py") == ["RepLinkFP"]
+    shutil.rmtree(tmpdir)
+    print("ArtifactStore OK")
+
+
+if __name__ == "__main__":
+    test_ArtifactStore()
@@ -0,0 +1,312 @@
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import random
+import socket
+import platform
+import resource
+import multiprocessing as mp
+import numpy as np
+
+from Solver import getBackend
+from Profiling import flushCounters
+
+BenchmarkSaveDir = "Benchmark-save"
+
+# Parameter grids.  Every stage runs over the dimensions it depends on, and
+# cases that are out of reach (ETM enumeration at large K, say) end as a
+# "timeout" record instead of stalling the suite.  benchmarkM gives every
+# trunk its own size, so the orbit enumeration runs over its own list of
+# trunk sets with equal sizes.
+BenchmarkGrids = { "quick": { "radix": (4, 8),
+                              "K": (2, 3, 4),
+                              "numFailure": (0, 1, 2),
+                              "orbitM": ((2, 2, 4), (2, 2, 2, 2), (10, 10, 10, 20), (2, 2, 2, 2, 2)) },
+                   "full": { "radix": (4, 8, 16, 32, 64),
+                             "K": (2, 3, 4, 5, 6, 7, 8),
+                             "numFailure": (0, 1, 2, 3, 4),
+                             "orbitM": ((2, 2, 4), (2, 2, 2, 2), (10, 10, 10, 20), (2, 2, 2, 2, 2),
+                                        (2, 2, 3, 3, 6), (3, 3, 3, 3, 4)) } }
+
+BenchmarkStages = ("ETM", "ETMOrbits", "Wiring", "BaselineWiring", "LinkFP", "Representative",
+                   "L1FP", "Capacity", "Hash")
+
+# Local stand-in for Gurobi, so results do not depend on a license.  HiGHS
+# runs on Python 3 (scipy >= 1.9), the runtime the suite is supported on.
+BenchmarkSolver = "HiGHS"
+
+
+def benchmarkFilename(label):
+    return "Benchmark-" + label + ".jsonl"
+
+
+# K trunks of unequal size filling the radix * radix/2 ports
+def benchmarkM(radix, K):
+    numPort = radix * (radix//2)
+    if K > numPort:
+        return None
+    M = [numPort * (k+1) // (K*(K+1)//2) for k in range(K)]
+    M = [max(1, m) for m in M]
+    M[-1] += numPort - sum(M)
+    if M[-1] < 1:
+        return None
+    return tuple(sorted(M))
+
+
+def randomLinkFailure(radix, numFailure, seed):
+    rng = random.Random(seed)
+    links = [("e"+str(e), "c"+str(c)) for e in range(radix) for c in range(radix//2)]
+    return tuple(sorted(rng.sample(links, min(numFailure, len(links)))))
+
+
+def benchmarkCases(stages, grid):
+    for stage in stages:
+        if stage == "ETMOrbits":
+            for M in grid["orbitM"]:
+                yield (stage, { "M": M })
+            continue
+        for radix in grid["radix"]:
+            for K in grid["K"]:
+                M = benchmarkM(radix, K)
+                if M is None:
+                    continue
+                if stage in ("ETM", "Wiring", "BaselineWiring"):
+                    yield (stage, { "radix": radix, "M": M })
+                    continue
+                for numFailure in grid["numFailure"]:
+                    if stage == "L1FP" and numFailure > radix:
+                        continue
+                    yield (stage, { "radix": radix, "M": M, "numFailure": numFailure })
+
+
+# Stages.  Each does its own setup and returns (time of the measured call,
+# metrics); setup such as ETM enumeration is not part of the time.
+def benchmarkETM(params, solver):
+    from ExtremeTraffic import computeETM
+    t = time.time()
+    etms = computeETM(params["M"])
+    return (time.time() - t, { "numETM": len(etms) })
+
+
+# The orbit path itself, whichever path computeETM would take for M.  The
+# cdd time of the same M is a metric, so one record shows both sides of the
+# crossover noted at OrbitMinK in ExtremeTraffic.
+def benchmarkETMOrbits(params, solver):
+    from ExtremeTraffic import computeETMOrbits, expandETMOrbits, computeETMStack
+    M = params["M"]
+    t = time.time()
+    orbits = computeETMOrbits(M)
+    dt = time.time() - t
+    numETM = len(expandETMOrbits(orbits, M))
+    t = time.time()
+    assert len(computeETMStack(M)) == numETM
+    return (dt, { "numOrbit": len(orbits), "numETM": numETM, "cddTime": time.time() - t })
+
+
+def benchmarkWiring(params, solver):
+    from ExtremeTraffic import computeETM, pruneETM
+    from Wiring import optimizeWiring, scoreWirings
+    (radix, M) = (params["radix"], params["M"])
+    etms = pruneETM(computeETM(M), "Wiring")[0]
+    t = time.time()
+    wiring = optimizeWiring(radix, M, "OptimalSym", getBackend(solver), etms)
+    dt = time.time() - t
+    return (dt, { "numETM": len(etms), "score": float(scoreWirings(M, np.array([wiring]), etms)[0]) })
+
+
+def benchmarkBaselineWiring(params, solver):
+    from Wiring import getBaselineWiring
+    t = time.time()
+    getBaselineWiring(params["radix"], params["M"])
+    return (time.time() - t, dict())
+
+
+def benchmarkLinkFP(params, solver):
+    from Wiring import getBaselineWiring
+    from LinkFailurePattern import FailurePattern
+    (radix, M) = (params["radix"], params["M"])
+    FP = FailurePattern(radix, getBaselineWiring(radix, M))
+    t = time.time()
+    fps = FP.setNumFailure(params["numFailure"])
+    return (time.time() - t, { "numPattern": len(fps) })
+
+
+def benchmarkRepresentative(params, solver, numQuery=1000):
+    from Wiring import getBaselineWiring
+    from LinkFailurePattern import FailurePattern
+    (radix, M) = (params["radix"], params["M"])
+    FP = FailurePattern(radix, getBaselineWiring(radix, M))
+    fps = [randomLinkFailure(radix, params["numFailure"], seed) for seed in range(numQuery)]
+    t = time.time()
+    for fp in fps:
+        FP.getRepresentative(fp)
+    return (time.time() - t, { "numQuery": numQuery })
+
+
+def benchmarkL1FP(params, solver):
+    from Wiring import getBaselineWiring
+    from L1FailurePattern import getL1FP
+    (radix, M) = (params["radix"], params["M"])
+    wiring = getBaselineWiring(radix, M)
+    t = time.time()
+    fps = getL1FP(wiring, params["numFailure"])
+    return (time.time() - t, { "numPattern": len(fps) })
+
+
+def benchmarkCapacity(params, solver):
+    from ExtremeTraffic import computeETM, pruneETM
+    from Wiring import getBaselineWiring
+    from Router import Router
+    from CapacityVerification import calculateEffectiveCapacityRouter
+    (radix, M) = (params["radix"], params["M"])
+    etms = pruneETM(computeETM(M), "Capacity")[0]
+    wiring = getBaselineWiring(radix, M)
+    router = Router(radix)
+    router.setLinkFailure(randomLinkFailure(radix, params["numFailure"], 0))
+    backend = getBackend(solver)
+    t = time.time()
+    beta = min([calculateEffectiveCapacityRouter(router, wiring, etm, backend) for etm in etms])
+    return (time.time() - t, { "numETM": len(etms), "beta": float(beta) })
+
+
+def benchmarkHash(params, solver):
+    from ExtremeTraffic import computeETM, pruneETM
+    from Wiring import getBaselineWiring
+    from Router import Router
+    from CapacityVerification import CapacityModel, verifyCapacity
+    from CompactHash import computeCompactHash
+    (radix, M) = (params["radix"], params["M"])
+    etms = pruneETM(computeETM(M), "Hash")[0]
+    wiring = getBaselineWiring(radix, M)
+    lkfp = randomLinkFailure(radix, params["numFailure"], 0)
+    router = Router(radix)
+    router.setLinkFailure(lkfp)
+    backend = getBackend(solver)
+    capModel = CapacityModel(radix, wiring, backend=backend)
+    capModel.setRouter(router)
+    effCap = verifyCapacity(capModel, etms, "PerETM", None)
+    t = time.time()
+    computeCompactHash(radix, M, "Baseline", "Optimal", lkfp, effCap, wiring, etms, backend)
+    return (time.time() - t, { "numETM": len(etms), "effCap": float(effCap) })
+
+
+BenchmarkFunctions = { "ETM": benchmarkETM,
+                       "ETMOrbits": benchmarkETMOrbits,
+                       "Wiring": benchmarkWiring,
+                       "BaselineWiring": benchmarkBaselineWiring,
+                       "LinkFP": benchmarkLinkFP,
+                       "Representative": benchmarkRepresentative,
+                       "L1FP": benchmarkL1FP,
+                       "Capacity": benchmarkCapacity,
+                       "Hash": benchmarkHash }
+
+
+# Runs in a fresh worker process, so ru_maxrss is the peak of this case.
+# The worker exits without atexit handlers, so counters are flushed here.
+def runBenchmarkCase(task):
+    (stage, params, solver) = task
+    (dt, metrics) = BenchmarkFunctions[stage](params, solver)
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    flushCounters()
+    return (dt, metrics, maxrss)
+
+
+def runBenchmark(label, gridName="quick", stages=BenchmarkStages, timeout=300, solver=BenchmarkSolver):
+    assert sys.version_info[0] >= 3, "The benchmark suite runs on Python 3"
+    # Fail before the first case rather than record an error for each
+    getBackend(solver)
+    if not os.path.isdir(BenchmarkSaveDir):
+        os.makedirs(BenchmarkSaveDir)
+    fullpath = BenchmarkSaveDir + "/" + benchmarkFilename(label)
+    host = { "host": socket.gethostname(),
+             "python": platform.python_version(),
+             "numpy": np.__version__ }
+
+    fp = open(fullpath, "w")
+    for (stage, params) in benchmarkCases(stages, BenchmarkGrids[gridName]):
+        record = { "label": label,
+                   "stage": stage,
+                   "params": params,
+                   "solver": solver,
+                   "timeout": timeout,
+                   "created": time.time(),
+                   "env": host }
+        pool = mp.Pool(1)
+        try:
+            result = pool.apply_async(runBenchmarkCase, ((stage, params, solver),))
+            (dt, metrics, maxrss) = result.get(timeout)
+            record.update({ "status": "ok", "time": dt, "metrics": metrics, "maxrss": maxrss })
+            pool.close()
+        except mp.TimeoutError:
+            record.update({ "status": "timeout", "time": None })
+        except Exception as e:
+            record.update({ "status": "error", "time": None, "error": repr(e) })
+        finally:
+            pool.terminate()
+            pool.join()
+        fp.write(json.dumps(record, sort_keys=True) + "\n")
+        fp.flush()
+        print(stage, params, record["status"], record["time"])
+    fp.close()
+    print("Save result to", fullpath)
+
+
+def load_Benchmark(label):
+    fullpath = BenchmarkSaveDir + "/" + benchmarkFilename(label)
+    fp = open(fullpath, "r")
+    records = [json.loads(line) for line in fp if line.strip()]
+    fp.close()
+    return records
+
+
+def benchmarkKey(record):
+    return json.dumps([record["stage"], record["params"]], sort_keys=True)
+
+
+# Cases of new that are slower than in base by more than the given ratio,
+# or that no longer finish.  Cases faster than minTime in both runs are
+# too noisy to compare.  An error record in either run is a failure, since
+# the case was not measured; a timeout in both runs is a case out of reach.
+# Returns (stage, params, base time or status, new time or status).
+def compareBenchmarks(baseLabel, newLabel, ratio=1.2, minTime=0.05):
+    base = dict((benchmarkKey(r), r) for r in load_Benchmark(baseLabel))
+    regressions = list()
+    for b in base.values():
+        if b["status"] == "error":
+            regressions.append((b["stage"], b["params"], b["status"], None))
+    for r in load_Benchmark(newLabel):
+        b = base.get(benchmarkKey(r), None)
+        if r["status"] == "error":
+            regressions.append((r["stage"], r["params"], None if b is None else b["time"], r["status"]))
+            continue
+        if b is None or b["status"] != "ok":
+            continue
+        if r["status"] != "ok":
+            regressions.append((r["stage"], r["params"], b["time"], r["status"]))
+            continue
+        if max(b["time"], r["time"]) < minTime:
+            continue
+        if r["time"] > ratio * b["time"]:
+            regressions.append((r["stage"], r["params"], b["time"], r["time"]))
+    return regressions
+
+
+if __name__ == "__main__":
+    # python Benchmark.py run <label> [quick|full]
+    # python Benchmark.py compare <base label> <new label>
+    if len(sys.argv) >= 3 and sys.argv[1] == "run":
+        gridName = "quick"
+        if len(sys.argv) > 3:
+            gridName = sys.argv[3]
+        runBenchmark(sys.argv[2], gridName)
+    elif len(sys.argv) == 4 and sys.argv[1] == "compare":
+        regressions = compareBenchmarks(sys.argv[2], sys.argv[3])
+        for (stage, params, baseTime, newTime) in regressions:
+            print("Regression:", stage, params, baseTime, "->", newTime)
+        print(len(regressions), "regressions")
+        if len(regressions) > 0:
+            sys.exit(1)
+    else:
+        print("Usage: Benchmark.py run <label> [quick|full] | compare <base> <new>")
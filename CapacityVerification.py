@@ -1,124 +1,298 @@
 from __future__ import print_function
 import time
 import numpy as np
-import gurobipy as gp
+import scipy.sparse as sp
 
+from Solver import getBackend, availableBackends, LinearProgram
 from Router import Router
-from ExtremeTraffic import load_ETM
-from Wiring import load_Wiring
+from Topology import Topology
+from ExtremeTraffic import load_ETM, load_PrunedETM
+from Wiring import load_Wiring, optimizeWiring
 from LinkFailurePattern import load_RepLinkFP
 from L1FailurePattern import getL1FP
+from Profiling import profiled
 
 
 
-def calculateEffectiveCapacityRouter(router, wiring, tmat):
-    numEdge = router.numEdge
-    numCore = router.numCore
-    numTrunk = len(wiring[0])
-    numTrunkWire = [ sum( [ wiring[ei][ti] for ei in range(numEdge) ] ) for ti in range(numTrunk) ]
+# Builds and solves a fresh model per call, use CapacityModel across scenarios
+def calculateEffectiveCapacityRouter(router, wiring, tmat, backend=None):
+    capModel = CapacityModel(router.radix, wiring, backend=backend)
+    capModel.setRouter(router)
+    capModel.setTraffic(tmat)
+    return capModel.solve()
 
-    edgeNodes = set(["e"+str(ei) for ei in range(numEdge)])
-    edgeResNodes = edgeNodes.difference(router.failedL1s)
-    coreNodes = set(["c"+str(ci) for ci in range(numCore)])
-    unLinks = set([(en, cn) for en in edgeNodes for cn in coreNodes])
-    diLinks = set(list(unLinks) + [(l[1], l[0]) for l in unLinks])
-    trunks = set(["t"+str(ti) for ti in range(numTrunk)])
-    trunkPairs = set([(tn, tm) for tn in trunks for tm in trunks])
 
-    # formulate optimization
-    model = gp.Model()
-    
-    xindex = gp.tuplelist((ni, nj, ti, tj) for (ni, nj) in diLinks for (ti, tj) in trunkPairs if ti != tj)
-    x = model.addVars(xindex, lb=0, ub=1, vtype=gp.GRB.CONTINUOUS, name="x_")
+# Constraint matrices of the effective capacity LP over integer indices.
+# Link (e, c) is e*numCore + c, the up direction e -> c is [0, numLink) and
+# the down direction c -> e is [numLink, 2*numLink).  Flow variable
+# (tm, l, k) of traffic matrix tm, directed link l and trunk pair k is
+# column (tm*2*numLink + l)*numPair + k and beta is the last column.
+# Rows of Aeq are core conservation (tm, c, k) followed by edge conservation
+# (tm, e, k); rows of Aub are link capacities (tm, l).
+def capacityMatrix(numEdge, numCore, numPair, numTM=1):
+    numLink = numEdge * numCore
+    numX = numTM * 2*numLink * numPair
+    numVar = numX + 1
 
-    beta = model.addVar(lb=0, ub=1, vtype=gp.GRB.CONTINUOUS, name="beta")
-    
-    model.update()
-    model.setParam("LogToConsole", 0)
-    model.setObjective(beta, gp.GRB.MAXIMIZE)
-
-    # Flow conservation at core switches
-    c_cons = gp.tupledict()
-    for cn in coreNodes:
-        for (ti, tj) in trunkPairs:
-            if ti == tj:
-                continue
-            c_cons[cn, ti, tj] = model.addConstr(x.sum("*", cn, ti, tj) - x.sum(cn, "*", ti, tj) == 0, name="c_{0}_{1}_{2}".format(cn, ti, tj))
-
-    # Flow conservation at edge switches
-    tf = gp.tupledict()
-    for ti in range(numTrunk):
-        tn = "t"+str(ti)
-        for tj in range(numTrunk):
-            tm = "t"+str(tj)
-            if ti == tj:
-                assert tmat[ti, tj] == 0
-                continue
-            tf[tn, tm] = np.float64(tmat[ti, tj])
-
-    numEdgeWire = gp.tupledict()
-    for en in edgeNodes:
-        for tn in trunks:
-            numEdgeWire[en, tn] = wiring[int(en[1:])][int(tn[1:])]
-    numResWire = gp.tupledict()
-    for tn in trunks:
-        numResWire[tn] = 0
-        for en in edgeResNodes:
-            numResWire[tn] += numEdgeWire[en, tn]
-        if numResWire[tn] == 0:
+    (tm, e, c, k) = np.meshgrid(np.arange(numTM), np.arange(numEdge), np.arange(numCore), np.arange(numPair), indexing='ij')
+    (tm, e, c, k) = (tm.ravel(), e.ravel(), c.ravel(), k.ravel())
+    up = e*numCore + c
+    xUp = (tm*2*numLink + up)*numPair + k
+    xDown = (tm*2*numLink + numLink + up)*numPair + k
+
+    numCoreRow = numTM * numCore * numPair
+    numEdgeRow = numTM * numEdge * numPair
+    coreRow = (tm*numCore + c)*numPair + k
+    edgeRow = numCoreRow + (tm*numEdge + e)*numPair + k
+    ones = np.ones(len(up))
+    rows = np.concatenate((coreRow, coreRow, edgeRow, edgeRow))
+    cols = np.concatenate((xUp, xDown, xDown, xUp))
+    vals = np.concatenate((ones, -ones, ones, -ones))
+    Aeq = sp.csr_matrix((vals, (rows, cols)), shape=(numCoreRow + numEdgeRow, numVar))
+
+    x = np.arange(numX)
+    Aub = sp.csr_matrix((np.ones(numX), (x // numPair, x)), shape=(numTM * 2*numLink, numVar))
+    return (Aeq, Aub)
+
+
+# Effective capacity LP of one (radix, wiring), built once and re-solved.
+# A scenario only changes the link capacities and the beta coefficients of
+# the L1 flow conservation rows, so the solver warm starts from the last basis.
+# With numTM > 1 the model stacks one flow block per traffic matrix under a
+# shared beta, so a single solve gives the min over the matrices of max beta.
+class CapacityModel():
+    @profiled("CapacityModel.build")
+    def __init__(self, radix, wiring, numTM=1, backend=None):
+        t = time.time()
+        topology = Topology(radix, wiring)
+        self.topology = topology
+        self.numEdge = topology.numEdge
+        self.numCore = topology.numCore
+        self.numLink = topology.numLink
+        self.numTrunk = topology.numTrunk
+        self.numTM = numTM
+        self.wiring = topology.wiring
+        self.wiringArray = topology.wiringArray
+        self.trunkPairs = topology.trunkPairs
+        self.pairSrc = topology.pairSrc
+        self.pairDst = topology.pairDst
+
+        numEdge = self.numEdge
+        numCore = self.numCore
+        numLink = self.numLink
+        numPair = len(self.trunkPairs)
+
+        if backend is None:
+            backend = getBackend()
+        self.backend = backend
+
+        (Aeq, Aub) = capacityMatrix(numEdge, numCore, numPair, numTM)
+        numVar = Aeq.shape[1]
+        obj = np.zeros(numVar)
+        obj[-1] = 1
+        lp = LinearProgram(obj, Aeq, np.zeros(Aeq.shape[0]), Aub, np.ones(Aub.shape[0]),
+                           np.zeros(numVar), np.ones(numVar), maximize=True)
+        self.model = backend.createModel(lp)
+        self.betaCol = numVar - 1
+        self.edgeRow0 = numTM * numCore * numPair
+        self.betaCoeff = np.zeros((numTM, numEdge, numPair))
+        self.linkCap = np.ones(2*numLink)
+
+        self.failedL1s = frozenset()
+        self.numResWire = None
+        self.tmats = None
+        self.setFailure(set(), np.zeros(numLink, dtype=bool))
+        self.buildTime = time.time() - t
+        self.solveTime = 0
+        self.numSolve = 0
+
+
+    # failedL1s are edge IDs, failedLinkMask is a mask over link IDs of
+    # every link that is down (Router.getFailedLinkMask)
+    def setFailure(self, failedL1s, failedLinkMask):
+        numLink = self.numLink
+        linkCap = np.tile(np.where(failedLinkMask, 0.0, 1.0), 2)
+        changed = np.nonzero(linkCap != self.linkCap)[0]
+        if len(changed) > 0:
+            rows = (np.arange(self.numTM)[:, None]*2*numLink + changed[None, :]).ravel()
+            caps = np.tile(linkCap[changed], self.numTM)
+            self.model.setRHS("<", rows, caps)
+        self.linkCap = linkCap
+
+        self.failedL1s = frozenset(failedL1s)
+        alive = np.ones(self.numEdge, dtype=bool)
+        alive[list(self.failedL1s)] = False
+        self.numResWire = [int(n) for n in self.wiringArray[alive].sum(axis=0)]
+
+
+    def setRouter(self, router):
+        self.setFailure(router.failedL1IDs, router.getFailedLinkMask())
+
+
+    def setTraffic(self, tmat):
+        self.setTrafficSet([tmat])
+
+
+    def setTrafficSet(self, tmats):
+        assert len(tmats) == self.numTM
+        diag = np.arange(self.numTrunk)
+        assert np.all(np.asarray(tmats)[:, diag, diag] == 0)
+        self.tmats = tmats
+
+
+    # Upper bound on beta of one traffic matrix under the current failure.
+    # Every live L1 switch must push its net outgoing traffic up through its
+    # live links and pull its net incoming traffic down, and every trunk
+    # must carry its traffic on the residual wires.
+    def betaUpperBound(self, tmat):
+        return self.betaUpperBounds(np.asarray(tmat, dtype='float64')[None, :, :])[0]
+
+
+    # betaUpperBound of each matrix of a T x K x K stack, e.g. an ETMStack
+    def betaUpperBounds(self, tmats):
+        tf = np.asarray(tmats, dtype='float64')
+        T = tf.shape[0]
+        if 0 in self.numResWire:
+            return np.zeros(T)
+        numResWire = np.array(self.numResWire, dtype='float64')
+        wireShare = self.wiringArray / numResWire
+        for e in self.failedL1s:
+            wireShare[e] = 0
+
+        betaUB = np.ones(T)
+        pairTraffic = tf[:, self.pairSrc, self.pairDst]
+        positive = pairTraffic > 0
+        ratio = np.where(positive, numResWire[self.pairSrc][None, :] / np.where(positive, pairTraffic, 1), np.inf)
+        betaUB = np.minimum(betaUB, ratio.min(axis=1, initial=np.inf))
+
+        # demand[t, e, i, j] = tf[t, i, j] * (share of e at trunk i - share at trunk j)
+        shareDiff = wireShare[:, :, None] - wireShare[:, None, :]
+        upDemand = np.einsum('tij,eij->te', tf, np.maximum(shareDiff, 0))
+        downDemand = np.einsum('tij,eij->te', tf, np.maximum(-shareDiff, 0))
+        linkCap = np.array(self.linkCap[:self.numLink]).reshape((self.numEdge, self.numCore)).sum(axis=1)
+        for d in (upDemand, downDemand):
+            positive = d > 0
+            ratio = np.where(positive, linkCap[None, :] / np.where(positive, d, 1), np.inf)
+            betaUB = np.minimum(betaUB, ratio.min(axis=1, initial=np.inf))
+        return betaUB
+
+
+    def solve(self):
+        if 0 in self.numResWire:
             return 0
+        numResWire = np.array(self.numResWire, dtype='float64')
+
+        # Trunk capacity constraints only bound beta
+        tf = np.asarray(self.tmats, dtype='float64')[:, self.pairSrc, self.pairDst]
+        srcWire = np.broadcast_to(numResWire[self.pairSrc], tf.shape)
+        positive = tf > 0
+        betaUB = 1
+        if np.any(positive):
+            betaUB = min(1, np.min(srcWire[positive] / tf[positive]))
 
+        # betaCoeff[tm, e, k] = tf[tm, k] * (share of e at trunk i - share at trunk j)
+        wireShare = self.wiringArray / numResWire
+        for e in self.failedL1s:
+            wireShare[e] = 0
+        betaCoeff = tf[:, None, :] * (wireShare[:, self.pairSrc] - wireShare[:, self.pairDst])[None, :, :]
+        changed = np.nonzero((betaCoeff != self.betaCoeff).ravel())[0]
+        if len(changed) > 0:
+            self.model.setCoeffs("=", self.edgeRow0 + changed, self.betaCol, betaCoeff.ravel()[changed])
+        self.betaCoeff = betaCoeff
+        self.model.setBounds([self.betaCol], ub=[betaUB])
 
-    e_cons = gp.tupledict()
-    for en in edgeResNodes:
-        for (ti, tj) in trunkPairs:
-            if ti == tj:
-                continue
-            inflow = x.sum("*", en, ti, tj) + beta * numEdgeWire[en, ti] * tf[ti, tj] / numResWire[ti]
-            outflow = x.sum(en, "*", ti, tj) + beta * numEdgeWire[en, tj] * tf[ti, tj] / numResWire[tj]
-            e_cons[en, ti, tj] = model.addConstr(inflow == outflow, name="e_{0}_{1}_{2}".format(en, ti, tj))
-
-    # Trunk capacity constraints
-    t_cons = gp.tupledict()
-    for en in edgeResNodes:
-        for (ti, tj) in trunkPairs:
-            if ti == tj:
-                continue
-            t_cons[en, ti, tj] = model.addConstr(beta * tf[ti, tj] / numResWire[ti] <= 1, name="t_{0}_{1}_{2}".format(en, ti , tj))
-
-    # Link capacity constraints
-    l_cons = gp.tupledict()
-    failedLinks = router.getAllFailedLinks()
-    for l in unLinks:
-        (en, cn) = l        
-        if l in failedLinks:
-            cap = 0
+        sol = self.model.solve()
+        self.solveTime = sol.runtime
+        self.numSolve += 1
+        if sol.status == "Optimal":
+            return sol.x[self.betaCol]
+        elif sol.status == "Infeasible":
+            assert False, "Infeasible solution"
+            return -1
         else:
-            cap = 1
-        l_cons[en, cn] = model.addConstr(x.sum(en, cn, "*", "*") <= cap, name="l_{0}_{1}".format(en, cn))
-        l_cons[cn, en] = model.addConstr(x.sum(cn, en, "*", "*") <= cap, name="l_{0}_{1}".format(cn, en))
-
-    # call solver
-    model.optimize()
-    if model.status == gp.GRB.Status.OPTIMAL:
-        return beta.X
-    elif model.status == gp.GRB.Status.INFEASIBLE:
-        assert False, "Infeasible solution"
-        return -1
-    else:
-        assert False, "Solver Status " + str(model.status)
-        return -1
+            assert False, sol.status
+            return -1
 
 
+@profiled("verificationRouter")
 def verificationRouter(scenario):
     router = scenario["router"]
+    if "failure" in scenario:
+        router.setFailureMask(scenario["failure"])
     wiring = scenario["wiring"]
     M = scenario["M"]
-    
-    etms = load_ETM(M)
+
+    # Re-use the caller's ETMs across scenarios when they are given
+    if "etms" in scenario:
+        etms = scenario["etms"]
+    else:
+        etms = load_PrunedETM(M, "Capacity")
+
+    # "Joint" solves one LP stacking every ETM, "PerETM" solves one LP each
+    mode = scenario.get("mode", "PerETM")
+    if mode == "Joint":
+        numTM = len(etms)
+    elif mode == "PerETM":
+        numTM = 1
+    else:
+        assert False, "Unknown verification mode"
+    threshold = scenario.get("threshold", None)
+
+    # Consult the result cache before building or solving anything
+    cache = scenario.get("cache", None)
+    if cache is not None:
+        key = cache.scenarioKey(router.radix, wiring, M, etms,
+                                router.failedL2s, router.failedL1s, router.failedLinks)
+        result = cache.lookup(key, threshold)
+        if result is not None:
+            return result
+
+    # Re-use the caller's model across scenarios when one is given
+    if "model" in scenario:
+        capModel = scenario["model"]
+        assert capModel.numTM == numTM
+    else:
+        capModel = CapacityModel(router.radix, wiring, numTM)
+    capModel.setRouter(router)
+
+    t = time.time()
+    numSolve = capModel.numSolve
+    result = verifyCapacity(capModel, etms, mode, threshold)
+    if cache is not None:
+        meta = { "mode": mode,
+                 "time": time.time() - t,
+                 "numSolve": capModel.numSolve - numSolve }
+        cache.store(key, result, threshold, meta)
+    return result
+
+
+@profiled("verifyCapacity")
+def verifyCapacity(capModel, etms, mode, threshold):
+    # Threshold mode returns (pass, index of the violating ETM, beta) and
+    # stops at the first ETM below the threshold.  ETMs are tried in the
+    # order of their beta upper bound, so binding ETMs tend to come first
+    # and the remaining ETMs need no solve once one fails.  beta is always
+    # a solved LP beta, never the bound, as results share the cache.
+    if threshold is not None:
+        assert mode == "PerETM", "Threshold mode solves one LP per ETM"
+        bounds = capModel.betaUpperBounds(etms)
+        order = sorted(range(len(etms)), key=lambda t: bounds[t])
+        beta = 1
+        for t in order:
+            capModel.setTraffic(etms[t])
+            beta = min(beta, capModel.solve())
+            if beta < threshold:
+                return (False, t, beta)
+        return (True, None, beta)
+
+    if mode == "Joint":
+        capModel.setTrafficSet(etms)
+        return min(1, capModel.solve())
+
     beta = 1
     for etm in etms:
-        beta = min(beta, calculateEffectiveCapacityRouter(router, wiring, etm))
+        capModel.setTraffic(etm)
+        beta = min(beta, capModel.solve())
     return beta
 
     
@@ -141,6 +315,7 @@ def simpleTest():
     linkfps = load_RepLinkFP(M, numLinkFailure, algo)
     print("Link FPS:", linkfps)
 
+    capModel = CapacityModel(radix, wiring)
     for l1fp in l1fps:
         for linkfp in linkfps:        
             router.setL2Failure(l2fp)
@@ -149,10 +324,145 @@ def simpleTest():
 
             scenario = { "router": router,
                          "wiring": wiring,
-                         "M": M }
+                         "M": M,
+                         "model": capModel }
             beta = verificationRouter(scenario)
             print("Beta =", beta, ": L2-FP =", l2fp, ", L1-FP =", l1fp, ", LK-FP =", linkfp)
 
 
+def benchmark_CapacityModel():
+    radix = 4
+    M = (2, 2, 4)
+    algo = "Optimal"
+    numLinkFailure = 1
+
+    router = Router(radix)
+    wiring = load_Wiring(M, algo)
+    etms = load_ETM(M)
+    linkfps = load_RepLinkFP(M, numLinkFailure, algo)
+
+    # Rebuild a model for every (failure pattern, ETM) pair
+    dtRebuild = time.time()
+    for linkfp in linkfps:
+        router.setLinkFailure(linkfp)
+        for etm in etms:
+            calculateEffectiveCapacityRouter(router, wiring, etm)
+    dtRebuild = time.time() - dtRebuild
+
+    # Build once, then update and re-solve
+    capModel = CapacityModel(radix, wiring)
+    dtUpdate = 0
+    dtSolve = 0
+    numSolve = 0
+    for linkfp in linkfps:
+        router.setLinkFailure(linkfp)
+        for etm in etms:
+            t = time.time()
+            capModel.setRouter(router)
+            capModel.setTraffic(etm)
+            capModel.solve()
+            dtUpdate += time.time() - t - capModel.solveTime
+            dtSolve += capModel.solveTime
+            numSolve += 1
+
+    print("Scenarios:", numSolve)
+    print("Rebuild per scenario:", dtRebuild / numSolve, "sec.")
+    print("Persistent build (once):", capModel.buildTime, "sec.")
+    print("Persistent update per scenario:", dtUpdate / numSolve, "sec.")
+    print("Persistent solve per scenario:", dtSolve / numSolve, "sec.")
+
+
+
+def benchmark_CapacityMatrix():
+    for (radix, K) in ((4, 3), (8, 3), (16, 4), (32, 4), (32, 8), (64, 8)):
+        numPair = K*(K-1)
+        t = time.time()
+        capacityMatrix(radix, radix//2, numPair)
+        dtMatrix = time.time() - t
+
+        wiring = tuple(tuple([radix//2//K]*K) for e in range(radix))
+        capModel = CapacityModel(radix, wiring)
+        print("Radix", radix, "K", K, ": matrix", dtMatrix, "sec., model", capModel.buildTime, "sec.")
+
+
+def benchmark_JointETM():
+    radix = 4
+    M = (2, 2, 4)
+    algo = "Optimal"
+    numLinkFailure = 1
+
+    router = Router(radix)
+    wiring = load_Wiring(M, algo)
+    etms = load_PrunedETM(M, "Capacity")
+    linkfps = load_RepLinkFP(M, numLinkFailure, algo)
+
+    perModel = CapacityModel(radix, wiring)
+    jointModel = CapacityModel(radix, wiring, len(etms))
+    print("ETMs:", len(etms))
+    print("Joint build (once):", jointModel.buildTime, "sec.")
+
+    dtPer = 0
+    dtJoint = 0
+    for linkfp in linkfps:
+        router.setLinkFailure(linkfp)
+
+        t = time.time()
+        perBeta = verificationRouter({ "router": router,
+                                       "wiring": wiring,
+                                       "M": M,
+                                       "model": perModel })
+        dtPer += time.time() - t
+
+        t = time.time()
+        jointBeta = verificationRouter({ "router": router,
+                                         "wiring": wiring,
+                                         "M": M,
+                                         "mode": "Joint",
+                                         "model": jointModel })
+        dtJoint += time.time() - t
+        assert abs(perBeta - jointBeta) < 1e-6
+        print("Beta =", jointBeta, ": LK-FP =", linkfp)
+
+    print("Per-ETM loop per failure pattern:", dtPer / len(linkfps), "sec.")
+    print("Joint LP per failure pattern:", dtJoint / len(linkfps), "sec.")
+
+
+
+def benchmark_Backends():
+    radix = 4
+    M = (2, 2, 4)
+    algo = "Optimal"
+    numLinkFailure = 1
+
+    router = Router(radix)
+    wiring = load_Wiring(M, algo)
+    etms = load_PrunedETM(M, "Capacity")
+    linkfps = load_RepLinkFP(M, numLinkFailure, algo)
+
+    betas = dict()
+    for name in availableBackends():
+        backend = getBackend(name)
+        t = time.time()
+        optimizeWiring(radix, M, algo, backend)
+        dtWiring = time.time() - t
+
+        capModel = CapacityModel(radix, wiring, backend=backend)
+        t = time.time()
+        betas[name] = list()
+        for linkfp in linkfps:
+            router.setLinkFailure(linkfp)
+            betas[name].append(verificationRouter({ "router": router,
+                                                    "wiring": wiring,
+                                                    "M": M,
+                                                    "etms": etms,
+                                                    "model": capModel }))
+        dtVerify = time.time() - t
+        print(name, ": wiring MILP", dtWiring, "sec., verification", dtVerify / len(linkfps), "sec. per failure pattern")
+
+    names = list(betas.keys())
+    for name in names[1:]:
+        assert np.allclose(betas[names[0]], betas[name], atol=1e-6), (names[0], name)
+
+
 if __name__ == "__main__":
     simpleTest()
@@ -2,12 +2,14 @@ from __future__ import print_function
 import numpy as np
 import fractions as frlib
 import time
-import pickle
-import gurobipy as gp
 
+from Solver import getBackend, ModelBuilder
 from LinkFailurePattern import load_RepLinkFP
-from ExtremeTraffic import load_ETM
+from ExtremeTraffic import load_PrunedETM
 from Wiring import load_Wiring
+from Topology import parseLink, edgeName, coreName
+from Profiling import profiled
+from Compat import loadPickle, savePickle, gcd
 
 
 HashSaveDir = "Hash-save"
@@ -22,30 +24,29 @@ def hashResultFilenameSingle(M, lkfp_id, algo, algoHash):
     return fname
 
 
+@profiled("save_HashResultSingle")
 def save_HashResultSingle(result, M, lkfp_id, algo, algoHash):
     name = hashResultFilenameSingle(M, lkfp_id, algo, algoHash)
     fullpath = HashSaveDir + "/" + name
-    fp = open(fullpath, "w")
-    pickle.dump(result, fp)
-    fp.close()
+    savePickle(result, fullpath)
     print("Save result to", fullpath)
 
     
+@profiled("load_HashResultSingle")
 def load_HashResultSingle(M, lkfp_id, algo, algoHash):
-    name = defaultHashResultFilenameSingle(M, lkfp_id, algo, algoHash)
+    name = hashResultFilenameSingle(M, lkfp_id, algo, algoHash)
     fullpath = HashSaveDir + "/" + name
-    fp = open(fullpath, "r")
-    hashResult = pickle.load(fp)
-    fp.close()
+    hashResult = loadPickle(fullpath)
     return hashResult
 
 
 def getFGCD(f1, f2):
-    dlcm = (f1.denominator*f2.denominator)/frlib.gcd(f1.denominator, f2.denominator)
-    ngcd = frlib.gcd(f1*dlcm, f2*dlcm)
+    dlcm = (f1.denominator*f2.denominator) // gcd(f1.denominator, f2.denominator)
+    ngcd = gcd(f1*dlcm, f2*dlcm)
     return frlib.Fraction(ngcd, dlcm)
     
 
+@profiled("fractionalize")
 def fractionalize(radix, M, wiring):
     K = len(M)
     numEdge = radix
@@ -107,9 +108,10 @@ def fractionalize(radix, M, wiring):
     return (flowCount, fgcd, upL1s, downL1s)
 
 
-def solveCompactWeight(radix, M, flowSet, lkfp, effCap, algoHash):
+@profiled("solveCompactWeight")
+def solveCompactWeight(radix, M, flowSet, lkfp, effCap, algoHash, backend=None, etms=None):
     numEdge = radix
-    numCore = radix/2
+    numCore = radix // 2
     K = len(M)
     (flowCount, fgcd, upL1s, downL1s) = flowSet
     allUpL1s = set()
@@ -120,7 +122,8 @@ def solveCompactWeight(radix, M, flowSet, lkfp, effCap, algoHash):
                 continue
             allUpL1s.update(upL1s[(i, j)])
             allDownL1s.update(downL1s[(i, j)])    
-    etms = load_ETM(M)
+    if etms is None:
+        etms = load_PrunedETM(M, "Hash")
     if algoHash == "Optimal":
         pass
     elif algoHash == "Heuristic":
@@ -130,39 +133,51 @@ def solveCompactWeight(radix, M, flowSet, lkfp, effCap, algoHash):
         etms = [utm]
     else:
         assert False, "Invalid algorithm"    
-
-    model = gp.Model()
-
-    x = gp.tupledict()
+    if backend is None:
+        backend = getBackend()
+
+    model = ModelBuilder()
+
+    # Nodes are integer IDs, L1 switch e is e and L2 switch c is numEdge + c.
+    # x[n1, n2, i, j] is the number of (i, j) flow units on link n1 -> n2.
+    # xOut/xIn index its columns by (node, i, j), xEntry by the source node
+    # and xLink by the link with the trunk pair of each column.
+    x = dict()
+    xOut = dict()
+    xIn = dict()
+    xEntry = dict()
+    xLink = dict()
     for i in range(K):
         for j in range(K):
             if i == j:
                 continue
+            links = list()
             for e in upL1s[(i, j)]:
                 for c in range(numCore):
-                    en = "e"+str(e)
-                    cn = "c"+str(c)
-                    x[en, cn, i, j] = model.addVar(lb = 0,
-                                                   vtype = gp.GRB.INTEGER,
-                                                   name = "x_{0}_{1}_{2}_{3}".format(en, cn, i, j))
+                    links.append((e, numEdge + c))
             for e in downL1s[(i, j)]:
                 for c in range(numCore):
-                    en = "e"+str(e)
-                    cn = "c"+str(c)                
-                    x[cn, en, i, j] = model.addVar(lb = 0,
-                                                   vtype = gp.GRB.INTEGER,
-                                                   name = "x_{0}_{1}_{2}_{3}".format(cn, en, i, j))
+                    links.append((numEdge + c, e))
+            for (n1, n2) in links:
+                x[n1, n2, i, j] = model.addVar(lb = 0, integer = True)
+                xOut.setdefault((n1, i, j), list()).append(x[n1, n2, i, j])
+                xIn.setdefault((n2, i, j), list()).append(x[n1, n2, i, j])
+                xEntry.setdefault(n1, list()).append(x[n1, n2, i, j])
+                xLink.setdefault((n1, n2), list()).append((x[n1, n2, i, j], i, j))
+    failed = set(parseLink(l) for l in lkfp)
 
-    xmax = model.addVar(lb = 0, vtype = gp.GRB.CONTINUOUS, name = "xmax")                    
-    mu = model.addVar(lb = 1, vtype = gp.GRB.INTEGER, name = "mu")
+    xmax = model.addVar(lb = 0)
+    mu = model.addVar(lb = 1, integer = True)
 
-    model.setObjective(xmax, sense=gp.GRB.MINIMIZE)
+    model.setObjective([xmax], [1])
 
     # Auxiliary total number of entry at L2 switch
     for c in range(numCore):
-        model.addConstr(x.sum("c"+str(c), "*", "*", "*") <= xmax, name = "Entry_c" + str(c))
+        cols = xEntry.get(numEdge + c, [])
+        model.addConstr(cols + [xmax], [1]*len(cols) + [-1], "<", 0)
     for e in range(numEdge):
-        model.addConstr(x.sum("e"+str(e), "*", "*", "*") <= xmax, name = "Entry_e" + str(e))
+        cols = xEntry.get(e, [])
+        model.addConstr(cols + [xmax], [1]*len(cols) + [-1], "<", 0)
         
 
     # Flow conservation at L2 switch
@@ -171,9 +186,9 @@ def solveCompactWeight(radix, M, flowSet, lkfp, effCap, algoHash):
             if i == j:
                 continue    
             for c in range(numCore):
-                fin = x.sum("*", "c"+str(c), i, j)
-                fout = x.sum("c"+str(c), "*", i, j)
-                model.addConstr(fin == fout, name = "Match_c{0}_{1}_{2}".format(c, i, j))
+                fin = xIn.get((numEdge + c, i, j), [])
+                fout = xOut.get((numEdge + c, i, j), [])
+                model.addConstr(fin + fout, [1]*len(fin) + [-1]*len(fout), "=", 0)
 
     # Flow conservation at L1 switch
     for i in range(K):
@@ -181,60 +196,42 @@ def solveCompactWeight(radix, M, flowSet, lkfp, effCap, algoHash):
             if i == j:
                 continue
             for e in upL1s[(i, j)]:
-                fin = mu * flowCount[(i, j)][e]
-                fout = x.sum("e"+str(e), "*", i, j)
-                model.addConstr(fin == fout, name = "Match_+e{0}_{1}_{2}".format(e, i, j))
+                fout = xOut.get((e, i, j), [])
+                model.addConstr([mu] + fout, [flowCount[(i, j)][e]] + [-1]*len(fout), "=", 0)
             for e in downL1s[(i, j)]:
-                fin = x.sum("*", "e"+str(e), i, j)
-                fout = mu * flowCount[(i, j)][e]
-                model.addConstr(fin == fout, name = "Match_-e{0}_{1}_{2}".format(e, i, j))
+                fin = xIn.get((e, i, j), [])
+                model.addConstr(fin + [mu], [1]*len(fin) + [-flowCount[(i, j)][e]], "=", 0)
 
-    # Link capacity constraint L1 -> L2
-    tmc = -1
+    # Link capacity constraint L1 -> L2 and L2 -> L1
     for etm in etms:
-        tmc += 1
-        for e in allUpL1s:
-            for c in range(numCore):
-                en = "e" + str(e)
-                cn = "c" + str(c)
-                rate = 0
-                for (_, _, i, j) in x.subset(en, cn, "*", "*"):
-                    rate += x[en, cn, i, j] * float(fgcd[(i, j)]) * effCap * etm[i, j]
-                if (en, cn) in lkfp:
-                    cap = 0
-                else:
-                    cap = 1
-                model.addConstr(rate <= mu * cap, name = "Cap_{0}_{1}_{2}".format(en, cn, tmc))
-
-    # Link capacity constraint L2 -> L1
-    tmc = -1
-    for etm in etms:
-        tmc += 1
-        for e in allDownL1s:
-            for c in range(numCore):
-                en = "e" + str(e)
-                cn = "c" + str(c)
-                rate = 0
-                for (_, _, i, j) in x.subset(cn, en, "*", "*"):
-                    rate += x[cn, en, i, j] * float(fgcd[(i, j)]) * effCap * etm[i, j]
-                if (en, cn) in lkfp:
-                    cap = 0
-                else:
-                    cap = 1
-                model.addConstr(rate <= mu * cap, name = "Cap_{0}_{1}_{2}".format(cn, en, tmc))
+        for (L1s, up) in ((allUpL1s, True), (allDownL1s, False)):
+            for e in L1s:
+                for c in range(numCore):
+                    if up:
+                        link = (e, numEdge + c)
+                    else:
+                        link = (numEdge + c, e)
+                    cols = list()
+                    vals = list()
+                    for (col, i, j) in xLink.get(link, []):
+                        cols.append(col)
+                        vals.append(float(fgcd[(i, j)]) * effCap * etm[i, j])
+                    if (e, c) in failed:
+                        cap = 0
+                    else:
+                        cap = 1
+                    model.addConstr(cols + [mu], vals + [-cap], "<", 0)
 
-    # model.write("test.lp")
-    model.setParam("LogToConsole", 0)        
-    model.optimize()
-    if model.status == gp.GRB.Status.OPTIMAL:
+    sol = backend.createModel(model.build()).solve()
+    if sol.status == "Optimal":
         pass
-    elif model.status == gp.GRB.Status.INFEASIBLE:
+    elif sol.status == "Infeasible":
         print(M, effCap)
         assert False, "Model is infeasible."
     else:
-        assert False, "Solver Status " + str(model.status)
+        assert False, sol.status
 
-    # Format flow result
+    # Format flow result, keyed by the node ID links of x
     flowRoute = dict()
     for i in range(K):
         for j in range(K):
@@ -243,21 +240,19 @@ def solveCompactWeight(radix, M, flowSet, lkfp, effCap, algoHash):
             flowRoute[(i, j)] = dict()
             for e in upL1s[(i, j)]:
                 for c in range(numCore):
-                    en = "e" + str(e)
-                    cn = "c" + str(c)
-                    flowRoute[(i, j)][(en, cn)] = int(x[en, cn, i, j].X)
+                    flowRoute[(i, j)][(e, numEdge + c)] = int(round(sol.x[x[e, numEdge + c, i, j]]))
             for e in downL1s[(i, j)]:
                 for c in range(numCore):
-                    en = "e" + str(e)
-                    cn = "c" + str(c)                    
-                    flowRoute[(i, j)][(cn, en)] = int(x[cn, en, i, j].X)
+                    flowRoute[(i, j)][(numEdge + c, e)] = int(round(sol.x[x[numEdge + c, e, i, j]]))
             
     return flowRoute
 
 
+# weights[(i, j)][n] are the next hop weights of node n, with the node IDs
+# of solveCompactWeight.  Next hop (j, t) is wire t of trunk j.
 def resolveWeight(radix, M, wiring, flowSet, flowRoute):
     numEdge = radix
-    numCore = radix / 2
+    numCore = radix // 2
     K = len(M)
     (flowCount, fgcd, upL1s, downL1s) = flowSet    
 
@@ -268,56 +263,88 @@ def resolveWeight(radix, M, wiring, flowSet, flowRoute):
             if i == j:
                 continue
             weights[(i, j)] = dict()
+            route = flowRoute[(i, j)]
             for c in range(numCore):
-                cn = "c" + str(c)
-                weights[(i, j)][cn] = dict()
-                gcd = 0
-                for e in range(numEdge):
-                    en = "e" + str(e)
-                    if not flowRoute[(i, j)].has_key((cn, en)) or flowRoute[(i, j)][(cn, en)] == 0:
-                        continue
-                    gcd = frlib.gcd(gcd, flowRoute[(i, j)][(cn, en)])
+                cn = numEdge + c
+                hops = dict()
+                cgcd = 0
                 for e in range(numEdge):
-                    en = "e" + str(e)
-                    if not flowRoute[(i, j)].has_key((cn, en)) or flowRoute[(i, j)][(cn, en)] == 0:
+                    flow = route.get((cn, e), 0)
+                    if flow == 0:
                         continue
-                    weights[(i, j)][cn][en] = flowRoute[(i, j)][(cn, en)] / gcd
+                    hops[e] = flow
+                    cgcd = gcd(cgcd, flow)
+                for e in hops:
+                    hops[e] //= cgcd
+                weights[(i, j)][cn] = hops
     # L1 Hash
     for i in range(K):
         for j in range(K):
             if i == j:
                 continue    
+            route = flowRoute[(i, j)]
             for e in range(numEdge):
-                en = "e" + str(e)
                 # Augment trunk wires and internal links
-                weights[(i, j)][en] = dict()                
+                hops = dict()
                 for t in range(wiring[e][j]):
-                    weights[(i, j)][en]["t{0}_{1}".format(j, t)] = frlib.Fraction(1, M[j])
+                    hops[(j, t)] = frlib.Fraction(1, M[j])
                 for c in range(numCore):
-                    cn = "c" + str(c)
-                    if flowRoute[(i, j)].has_key((en, cn)):
-                        weights[(i, j)][en][cn] = flowRoute[(i, j)][(en, cn)] * fgcd[(i, j)]
+                    if (e, numEdge + c) in route:
+                        hops[numEdge + c] = route[(e, numEdge + c)] * fgcd[(i, j)]
                 # find FGCD and resolve weights
                 tfgcd = 0
-                for nh in weights[(i, j)][en].keys():
-                    tfgcd = getFGCD(tfgcd, weights[(i, j)][en][nh])
-                for nh in weights[(i, j)][en].keys():
+                for w in hops.values():
+                    tfgcd = getFGCD(tfgcd, w)
+                for nh in hops:
                     if tfgcd == 0:
-                        weights[(i, j)][en][nh] = int(weights[(i, j)][en][nh])
+                        hops[nh] = int(hops[nh])
                     else:
-                        assert weights[(i, j)][en][nh] / tfgcd == int(weights[(i, j)][en][nh] / tfgcd)
-                        weights[(i, j)][en][nh] = int(weights[(i, j)][en][nh] / tfgcd)
+                        assert hops[nh] / tfgcd == int(hops[nh] / tfgcd)
+                        hops[nh] = int(hops[nh] / tfgcd)
+                weights[(i, j)][e] = hops
     return weights
 
 
-def computeCompactHash(radix, M, algo, algoHash, lkfp, effCap):
+def nodeName(numEdge, n):
+    if n < numEdge:
+        return edgeName(n)
+    return coreName(n - numEdge)
+
+
+def hopName(numEdge, nh):
+    if isinstance(nh, tuple):
+        return "t{0}_{1}".format(nh[0], nh[1])
+    return nodeName(numEdge, nh)
+
+
+# The saved and returned form of a hash result, with string node names
+# ("e0", "c1", "t2_0") as in Hash-save
+def namedHashResult(radix, hashResult):
+    (flowSet, flowRoute, weights) = hashResult
+    numEdge = radix
+    namedRoute = dict()
+    for (ij, route) in flowRoute.items():
+        namedRoute[ij] = dict()
+        for ((n1, n2), flow) in route.items():
+            namedRoute[ij][(nodeName(numEdge, n1), nodeName(numEdge, n2))] = flow
+    namedWeights = dict()
+    for (ij, nodeWeights) in weights.items():
+        namedWeights[ij] = dict()
+        for (n, hops) in nodeWeights.items():
+            namedWeights[ij][nodeName(numEdge, n)] = dict((hopName(numEdge, nh), w) for (nh, w) in hops.items())
+    return (flowSet, namedRoute, namedWeights)
+
+
+@profiled("computeCompactHash")
+def computeCompactHash(radix, M, algo, algoHash, lkfp, effCap, wiring=None, etms=None, backend=None):
     K = len(M)
-    wiring = load_Wiring(M, algo)
+    if wiring is None:
+        wiring = load_Wiring(M, algo)
     flowSet = fractionalize(radix, M, wiring)
-    flowRoute = solveCompactWeight(radix, M, flowSet, lkfp, effCap, algoHash)
+    flowRoute = solveCompactWeight(radix, M, flowSet, lkfp, effCap, algoHash, backend, etms)
     weights = resolveWeight(radix, M, wiring, flowSet, flowRoute)
     hashResult = (flowSet, flowRoute, weights)
-    return hashResult
+    return namedHashResult(radix, hashResult)
 
 
 def test_LKFailure():
@@ -339,7 +366,7 @@ def test_LKFailure():
 
     print_hash_result(radix, M, wiring, flowSet, flowRoute, weights)
     result = (flowSet, flowRoute, weights)
-    save_HashResultSingle(result, M, lkfp_id, algo, algoHash)
+    save_HashResultSingle(namedHashResult(radix, result), M, lkfp_id, algo, algoHash)
 
 
 def test_L1Failure():
@@ -375,7 +402,7 @@ def test_L1Failure():
 
 def print_hash_result(radix, M, wiring, flowSet, flowRoute, weights):
     numEdge = radix
-    numCore = radix / 2
+    numCore = radix // 2
     K = len(M)
     (flowCount, fgcd, upL1s, downL1s) = flowSet    
 
@@ -392,56 +419,50 @@ def print_hash_result(radix, M, wiring, flowSet, flowRoute, weights):
             print("\tDown:\t", downL1s[(i, j)])
             print("\tRoute Up", end=": ")
             for e in upL1s[(i, j)]:
-                en = "e" + str(e)                
                 for c in range(numCore):
-                    cn = "c" + str(c)
-                    print("({0}, {1})".format(en, cn), flowRoute[(i, j)][(en, cn)], end=" ")
+                    print("({0}, {1})".format(edgeName(e), coreName(c)), flowRoute[(i, j)][(e, numEdge + c)], end=" ")
                 print("\t", end=" ")
             print()
 
             print("\tRoute Down", end=": ")
             for c in range(numCore):
-                cn = "c" + str(c)            
                 for e in downL1s[(i, j)]:
-                    en = "e" + str(e)
-                    print("({0}, {1})".format(cn, en), flowRoute[(i, j)][(cn, en)], end=" ")
+                    print("({0}, {1})".format(coreName(c), edgeName(e)), flowRoute[(i, j)][(numEdge + c, e)], end=" ")
                 print("\t", end=" ")
             print()
 
             print("\tWeight L1:")
             for e in range(numEdge):
-                en = "e" + str(e)
-                print("\t\t", en, weights[(i, j)][en])
+                hops = weights[(i, j)][e]
+                print("\t\t", edgeName(e), dict((hopName(numEdge, nh), w) for (nh, w) in hops.items()))
             print("\tWeight L2:")
             for c in range(numCore):
-                cn = "c" + str(c)            
-                print("\t\t", cn, weights[(i, j)][cn])
+                hops = weights[(i, j)][numEdge + c]
+                print("\t\t", coreName(c), dict((hopName(numEdge, nh), w) for (nh, w) in hops.items()))
 
     # Calculate statistic of WCMP entries
     maxWeight = 0
     print("Number of entries at L1:")
     for e in range(numEdge):
-        en = "e" + str(e)
         cntWeight = 0
         for i in range(K):
             for j in range(K):
                 if i == j:
                     continue
-                cntWeight += sum(weights[(i, j)][en].values())
+                cntWeight += sum(weights[(i, j)][e].values())
         maxWeight = max(maxWeight, cntWeight)
-        print("\t", en, cntWeight)
+        print("\t", edgeName(e), cntWeight)
 
     print("Number of entries at L2:")
     for c in range(numCore):
-        cn = "c" + str(c)
         cntWeight = 0
         for i in range(K):
             for j in range(K):
                 if i == j:
                     continue
-                cntWeight += sum(weights[(i, j)][cn].values())
+                cntWeight += sum(weights[(i, j)][numEdge + c].values())
         maxWeight = max(maxWeight, cntWeight)
-        print("\t", cn, cntWeight)
+        print("\t", coreName(c), cntWeight)
 
     print("Max number of entries", maxWeight)
 
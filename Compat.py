@@ -0,0 +1,35 @@
+from __future__ import print_function
+import sys
+import pickle
+
+# Pickled results are read and written in binary mode with protocol 2, so
+# files move between Python 2 and 3.  Files written by Python 2 hold numpy
+# arrays as byte strings, which Python 3 only unpickles as latin1.
+PickleProtocol = 2
+
+
+def loadPickle(fullpath):
+    fp = open(fullpath, "rb")
+    if sys.version_info[0] >= 3:
+        obj = pickle.load(fp, encoding="latin1")
+    else:
+        obj = pickle.load(fp)
+    fp.close()
+    return obj
+
+
+def savePickle(obj, fullpath):
+    fp = open(fullpath, "wb")
+    pickle.dump(obj, fp, PickleProtocol)
+    fp.close()
+
+
+def dumpsPickle(obj):
+    return pickle.dumps(obj, PickleProtocol)
+
+
+# Euclid on ints and Fractions alike; fractions.gcd is gone in Python 3
+def gcd(a, b):
+    while b:
+        (a, b) = (b, a % b)
+    return a
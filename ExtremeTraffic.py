@@ -1,9 +1,14 @@
 from __future__ import print_function
-import time
+import os
+import json
 import numpy as np
-import pickle
+import itertools
+import fractions
 import cdd
 
+from Profiling import profiled
+from Compat import loadPickle
+
 ETMSaveDir = "ETM-save"
 
 def ETMFilename(M):
@@ -13,29 +18,232 @@ def ETMFilename(M):
     return fname
 
 
+# ETMs of M as an ETMStack.  Data saved as a pickled list of matrices by
+# older versions is still read.
+@profiled("load_ETM")
 def load_ETM(M):
-    fname = ETMFilename(M)
-    fullpath = ETMSaveDir + "/" + fname
-    fp = open(fullpath, 'r')
-    etms = pickle.load(fp)
+    return load_ETMStack(M)
+
+
+@profiled("save_ETM")
+def save_ETM(etms, M):
+    if not isinstance(etms, ETMStack):
+        etms = stackETMs(etms)
+    save_ETMStack(etms, M)
+    
+
+# ETMs as one T x K x K array of integer numerators over a common
+# denominator.  Indexing and iteration give float matrices like the list
+# from load_ETM, np.asarray gives the whole T x K x K float stack for
+# vectorized consumers, and exact() keeps the rational values.
+class ETMStack():
+    def __init__(self, numer, denom=1):
+        self.numer = numer
+        self.denom = int(denom)
+
+    def __len__(self):
+        return self.numer.shape[0]
+
+    def __getitem__(self, t):
+        return np.asarray(self.numer[t], dtype='float64') / self.denom
+
+    def __iter__(self):
+        for t in range(len(self)):
+            yield self[t]
+
+    def __array__(self, dtype=None, copy=None):
+        stack = np.asarray(self.numer, dtype='float64') / self.denom
+        if dtype is not None:
+            stack = stack.astype(dtype)
+        return stack
+
+    def exact(self, t):
+        K = self.numer.shape[1]
+        etm = np.empty((K, K), dtype=object)
+        for i in range(K):
+            for j in range(K):
+                etm[i, j] = fractions.Fraction(int(self.numer[t, i, j]), self.denom)
+        return etm
+
+    def take(self, indices):
+        return ETMStack(np.asarray(self.numer)[list(indices)], self.denom)
+
+
+def lcm(a, b):
+    (x, y) = (a, b)
+    while y:
+        (x, y) = (y, x % y)
+    return a * b // x
+
+
+# Stack of float or Fraction ETMs; floats are read back as the nearest
+# fraction with a small denominator, as cdd's vertices are
+def stackETMs(etms, maxDenom=10**6):
+    exact = list()
+    denom = 1
+    for etm in etms:
+        fracs = list()
+        for x in np.asarray(etm).ravel():
+            if isinstance(x, fractions.Fraction):
+                f = x
+            else:
+                f = fractions.Fraction(float(x)).limit_denominator(maxDenom)
+                assert abs(float(f) - float(x)) <= 1e-9 * max(1, abs(float(x))), "ETM entry is not a small fraction"
+            fracs.append(f)
+            denom = lcm(denom, f.denominator)
+        exact.append(fracs)
+    K = int(round(np.sqrt(len(exact[0])))) if len(exact) > 0 else 0
+    numer = np.zeros((len(exact), K, K), dtype='int64')
+    for t in range(len(exact)):
+        for x in range(K*K):
+            numer[t, x // K, x % K] = int(exact[t][x] * denom)
+    return ETMStack(numer, denom)
+
+
+def ETMStackFilename(M):
+    return ETMFilename(M) + "-Stack"
+
+
+# A stack is saved as <fullpath>.npy with the numerators and <fullpath>.json
+# with the denominator and any other header fields.  The numerators are
+# memory-mapped on load, so only the ETMs used are read.
+def load_Stack(fullpath):
+    fp = open(fullpath + ".json", 'r')
+    header = json.load(fp)
     fp.close()
-    return etms
+    return (ETMStack(np.load(fullpath + ".npy", mmap_mode="r"), header["denominator"]), header)
 
 
-def save_ETM(wiring, M):
-    fname = ETMFilename(M)
-    fullpath = ETMSaveDir + "/" + fname
-    fp = open(fullpath, 'w')
-    pickle.dump(wiring, fp)
+def save_Stack(stack, fullpath, header):
+    np.save(fullpath + ".npy", np.asarray(stack.numer, dtype='int64'))
+    header = dict(header)
+    header["numETM"] = len(stack)
+    header["denominator"] = stack.denom
+    fp = open(fullpath + ".json", 'w')
+    json.dump(header, fp, sort_keys=True)
     fp.close()
-    print("Save result to", fullpath)
-    
+    print("Save result to", fullpath + ".npy")
 
-def generate_ETM(M):
+
+# Falls back to expanding saved orbit representatives, see computeETMOrbits
+@profiled("load_ETMStack")
+def load_ETMStack(M):
+    fullpath = ETMSaveDir + "/" + ETMStackFilename(M)
+    if os.path.exists(fullpath + ".npy"):
+        return load_Stack(fullpath)[0]
+    if os.path.exists(ETMSaveDir + "/" + ETMOrbitFilename(M) + ".npy"):
+        return expandETMOrbits(load_ETMOrbits(M), M)
+    return stackETMs(loadPickle(ETMSaveDir + "/" + ETMFilename(M)))
+
+
+@profiled("save_ETMStack")
+def save_ETMStack(stack, M):
+    save_Stack(stack, ETMSaveDir + "/" + ETMStackFilename(M), { "M": list(M) })
+
+
+def prunedETMFilename(M, consumer):
+    return ETMFilename(M) + "-Prune_" + consumer
+
+
+# Pruned ETMs as an ETMStack, pruned from load_ETM when they were never
+# saved.  Data saved as a pickle by older versions is still read.
+@profiled("load_PrunedETM")
+def load_PrunedETM(M, consumer):
+    fullpath = ETMSaveDir + "/" + prunedETMFilename(M, consumer)
+    if os.path.exists(fullpath + ".npy"):
+        return load_Stack(fullpath)[0]
+    if os.path.exists(fullpath):
+        return stackETMs(loadPickle(fullpath)["etms"])
+    (etms, dropped) = pruneETM(load_ETM(M), consumer)
+    return etms
+
+
+@profiled("save_PrunedETM")
+def save_PrunedETM(etms, dropped, M, consumer):
+    if not isinstance(etms, ETMStack):
+        etms = stackETMs(etms)
+    fullpath = ETMSaveDir + "/" + prunedETMFilename(M, consumer)
+    save_Stack(etms, fullpath, { "M": list(M), "consumer": consumer, "dropped": dropped })
+
+
+# Elements of the largest comparison temporary of pruneETM.  Rows are
+# compared a block at a time, so memory stays bounded for any number of ETMs.
+PruneBlockSize = 1 << 22
+
+
+# Drop ETMs that can never bind for the consumer.  All consumers are
+# monotone in the traffic matrix, so an ETM elementwise <= another one is
+# redundant for "Capacity" (beta), "Wiring" (objective) and "Hash" (link
+# capacity rows).  The wiring objective is also invariant under
+# (etm + etm^T) / 2, so "Wiring" compares the symmetrized matrices.
+# Returns the kept ETMs and a record per dropped ETM with the index of a
+# kept ETM that covers it.
+@profiled("pruneETM")
+def pruneETM(etms, consumer, tol=1e-9):
+    A = np.asarray(etms, dtype='float64')
+    if consumer in ("Capacity", "Hash"):
+        comp = A
+    elif consumer == "Wiring":
+        comp = (A + A.transpose(0, 2, 1)) / 2.0
+    else:
+        assert False, "Unknown ETM consumer"
+    T = len(etms)
+    F = comp.reshape((T, -1))
+    Ftol = F + tol
+    n = max(1, F.shape[1])
+
+    # An ETM is kept unless it is <= another one that is not equal to it,
+    # or equal to an earlier one.  Only the ETMs covering a row are checked
+    # for equality, so a block of rows needs one comparison with all ETMs.
+    kept = list()
+    step = max(1, PruneBlockSize // (max(1, T) * n))
+    for a0 in range(0, T, step):
+        le = np.all(F[a0:a0+step, None, :] <= Ftol[None, :, :], axis=2)
+        for i in range(le.shape[0]):
+            a = a0 + i
+            cover = np.nonzero(le[i])[0]
+            if not np.all(F[cover] <= Ftol[a]):
+                continue
+            if cover[0] < a:
+                continue
+            kept.append(a)
+
+    # Each dropped ETM is covered by the first kept ETM above it
+    keptSet = set(kept)
+    drop = [a for a in range(T) if a not in keptSet]
+    keptTol = Ftol[kept]
+    dropped = list()
+    step = max(1, PruneBlockSize // (max(1, len(kept)) * n))
+    for d0 in range(0, len(drop), step):
+        rows = drop[d0:d0+step]
+        le = np.all(F[rows, None, :] <= keptTol[None, :, :], axis=2)
+        for i in range(len(rows)):
+            k = int(np.argmax(le[i]))
+            assert le[i, k]
+            by = kept[k]
+            if np.all(F[by] <= Ftol[rows[i]]):
+                reason = "duplicate"
+            else:
+                reason = "dominated"
+            dropped.append({ "index": rows[i], "reason": reason, "by": by })
+    if isinstance(etms, ETMStack):
+        return (etms.take(kept), dropped)
+    return ([etms[a] for a in kept], dropped)
+
+
+def generate_PrunedETM(M):
+    etms = load_ETM(M)
+    for consumer in ("Capacity", "Wiring", "Hash"):
+        (pruned, dropped) = pruneETM(etms, consumer)
+        print(consumer, ": keep", len(pruned), "of", len(etms), "ETMs")
+        save_PrunedETM(pruned, dropped, M, consumer)
+
+
+# The ETM polytope in cdd's H-representation, rows [b, a1, a2, ...]
+# meaning b + a.x >= 0 over the row-major K x K traffic matrix x
+def etmInequalities(M):
     K = len(M)
     nEle = K**2
-
-    dt = time.time()
     rows = list()
 
     # row inequality
@@ -68,21 +276,202 @@ def generate_ETM(M):
         hfmt[1+K*k+k] = -1
         rows.append(hfmt)
 
+    return rows
+
+
+def generate_ETM(M):
+    save_ETMStack(computeETM(M), M)
+
+
+# Enumeration by orbits only pays off when cdd itself is slow and the orbits
+# are few.  Measured against computeETMStack (sec., ETMs / orbits), see the
+# "ETMOrbits" stage of Benchmark:
+#   K = 3, group 2   (2,2,4)        cdd 0.001, orbits 0.009   25 / 15
+#   K = 4, group 24  (2,2,2,2)      cdd 0.009, orbits 0.04   108 / 10
+#   K = 4, group 6   (10,10,10,20)  cdd 0.011, orbits 0.11   183 / 38
+#   K = 4, group 1 to 24            cdd 0.01 - 0.03, orbits 0.04 - 1.2
+#   K = 5, group 1   (1,2,3,4,6)    cdd 27,  orbits 164
+#   K = 5, group 4   (2,2,3,3,6)    cdd 15,  orbits 34   17922 / 4558
+#   K = 5, group 24  (3,3,3,3,4)    cdd 26,  orbits 6.3  14748 / 645
+#   K = 5, group 120 (2,2,2,2,2)    cdd 1.9, orbits 0.5    780 / 16
+# An orbit costs about ten cdd vertices, so the crossover is a group of
+# about ten permutations, and K >= 5.  Below it computeETM runs cdd, and
+# callers that want the smaller stored set, e.g. for (10,10,10,20), call
+# computeETMOrbits themselves (ArtifactStore.storedETMOrbits).
+OrbitMinK = 5
+OrbitMinGroup = 12
+
+
+def useETMOrbits(M):
+    return len(M) >= OrbitMinK and len(trunkPermutations(M)) >= OrbitMinGroup
+
+
+def computeETM(M):
+    if useETMOrbits(M):
+        return expandETMOrbits(computeETMOrbits(M), M)
+    return computeETMStack(M)
+
+
+@profiled("computeETMStack")
+def computeETMStack(M):
+    K = len(M)
+
+    rows = etmInequalities(M)
+
     mat = cdd.Matrix(rows, number_type='fraction')
     mat.rep_type = cdd.RepType.INEQUALITY
     poly = cdd.Polyhedron(mat)
     vs = poly.get_generators()
-    dt = time.time() - dt
-    print('Execution duration', dt, 'sec.')
 
-    etms = list()
+    # cdd gives exact rationals, kept as they are
+    vertices = list()
     for v in vs:
-        etm = np.array(v[1:], dtype='float64')
-        etm.resize((K, K))
-        etms.append(etm)
-    save_ETM(etms, M)
+        vertices.append([fractions.Fraction(x) for x in v[1:]])
+    if len(vertices) == 0:
+        return ETMStack(np.zeros((0, K, K), dtype='int64'))
+    return stackETMs(vertices)
+
+
+def ETMOrbitFilename(M):
+    return ETMFilename(M) + "-Orbit"
+
+
+@profiled("load_ETMOrbits")
+def load_ETMOrbits(M):
+    return load_Stack(ETMSaveDir + "/" + ETMOrbitFilename(M))[0]
+
+
+@profiled("save_ETMOrbits")
+def save_ETMOrbits(etms, M):
+    save_Stack(etms, ETMSaveDir + "/" + ETMOrbitFilename(M), { "M": list(M) })
+
+
+# Permutations of the trunks that only exchange trunks of equal capacity.
+# p acts on a traffic matrix as etm'[i, j] = etm[p[i], p[j]].
+def trunkPermutations(M):
+    K = len(M)
+    classes = dict()
+    for k in range(K):
+        classes.setdefault(M[k], list()).append(k)
+    classes = list(classes.values())
+    perms = list()
+    for images in itertools.product(*[itertools.permutations(c) for c in classes]):
+        p = list(range(K))
+        for (c, image) in zip(classes, images):
+            for (k, pk) in zip(c, image):
+                p[k] = pk
+        perms.append(tuple(p))
+    return perms
+
+
+def permuteETM(etm, p):
+    K = len(p)
+    return tuple(etm[p[x // K]*K + p[x % K]] for x in range(K*K))
+
+
+# Orbit representative: the lexicographically largest image
+def canonicalETM(etm, perms):
+    return max(permuteETM(etm, p) for p in perms)
+
+
+# Vertices adjacent to vertex v (a row-major tuple of numbers) of the
+# polytope b + a.x >= 0, given as sparse rows (b, [(x, a[x]), ...]).  The
+# edges at v are the extreme rays of the cone of the inequalities tight at
+# v, each followed until another inequality binds.  The polytope is
+# totally unimodular, so coordinates stay integral; any that are not are
+# kept as fractions.
+def adjacentETMs(v, rows):
+    n = len(v)
+    tight = list()
+    slack = list()
+    for (b, coeffs) in rows:
+        s = b + sum(a * v[x] for (x, a) in coeffs)
+        if s == 0:
+            row = [0] * (n + 1)
+            for (x, a) in coeffs:
+                row[1+x] = a
+            tight.append(row)
+        else:
+            slack.append((coeffs, s))
+    mat = cdd.Matrix(tight, number_type='fraction')
+    mat.rep_type = cdd.RepType.INEQUALITY
+    gens = cdd.Polyhedron(mat).get_generators()
+
+    neighbors = list()
+    for g in gens:
+        if g[0] != 0:
+            continue
+        ray = [fractions.Fraction(r) for r in g[1:]]
+        step = None
+        for (coeffs, s) in slack:
+            ar = sum(a * ray[x] for (x, a) in coeffs if ray[x] != 0)
+            if ar < 0:
+                t = s / (-ar)
+                if step is None or t < step:
+                    step = t
+        assert step is not None, "ETM polytope is unbounded"
+        u = list()
+        for x in range(n):
+            ux = v[x] + step * ray[x]
+            if ux.denominator == 1:
+                ux = int(ux.numerator)
+            u.append(ux)
+        neighbors.append(tuple(u))
+    return neighbors
+
+
+# Symmetry-reduced computeETM: one ETM per orbit under permutations of
+# equal-capacity trunks, found by the adjacency decomposition method.
+# Starting from the zero matrix, the neighbors of every new representative
+# are canonicalized and only unseen orbits are expanded, so cdd only ever
+# sees the small cones at representatives, never the whole polytope.
+@profiled("computeETMOrbits")
+def computeETMOrbits(M):
+    K = len(M)
+    rows = list()
+    for row in etmInequalities(M):
+        rows.append((row[0], [(x, row[1+x]) for x in range(K*K) if row[1+x] != 0]))
+    perms = trunkPermutations(M)
+
+    start = tuple([0] * (K*K))
+    reps = [start]
+    seen = set(reps)
+    i = 0
+    while i < len(reps):
+        for u in adjacentETMs(reps[i], rows):
+            u = canonicalETM(u, perms)
+            if u not in seen:
+                seen.add(u)
+                reps.append(u)
+        i += 1
+
+    return stackETMs([[fractions.Fraction(x) for x in v] for v in reps])
+
+
+# ETMStack of all ETMs of the orbits of the representatives in a stack
+def expandETMOrbits(etms, M):
+    K = len(M)
+    numer = np.asarray(etms.numer, dtype='int64')
+    images = list()
+    seen = set()
+    for p in trunkPermutations(M):
+        p = list(p)
+        for image in numer[:, p][:, :, p]:
+            key = image.tobytes()
+            if key in seen:
+                continue
+            seen.add(key)
+            images.append(image)
+    if len(images) == 0:
+        return ETMStack(np.zeros((0, K, K), dtype='int64'))
+    return ETMStack(np.array(images), etms.denom)
+
+
+def generate_ETMOrbits(M):
+    save_ETMOrbits(computeETMOrbits(M), M)
+
 
-    
 if __name__ == '__main__':
     M = (2, 2, 4)
     generate_ETM(M)
+    generate_PrunedETM(M)
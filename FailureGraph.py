@@ -1,12 +1,14 @@
 from __future__ import print_function
 import numpy as np
 
+from Topology import parseLink
+
 class FailureGraph():
     def __init__(self, radix, wiring):
         self.radix = radix
         self.numEdge = radix
-        self.numCore = radix / 2
-        self.numIntf = radix / 2
+        self.numCore = radix // 2
+        self.numIntf = radix // 2
 
         lwiring = list(wiring)
         lwiring.sort()
@@ -21,7 +23,7 @@ class FailureGraph():
     def __createL1Groups(self):
         self.L1GrpMap = dict()
         for ew in self.wiring:
-            if self.L1GrpMap.has_key(ew):
+            if ew in self.L1GrpMap:
                 continue
             grpId = len(self.L1GrpMap)
             self.L1GrpMap[ew] = grpId
@@ -30,7 +32,7 @@ class FailureGraph():
         for ewidx in range(self.numEdge):
             ew = self.wiring[ewidx]
             grpId = self.L1GrpMap[ew]
-            if not self.L1GrpInfo.has_key(grpId):
+            if grpId not in self.L1GrpInfo:
                 self.L1GrpInfo[grpId] = { "L1Index": [ewidx], "count": 1 }
             else:
                 self.L1GrpInfo[grpId]["L1Index"].append(ewidx)
@@ -39,10 +41,7 @@ class FailureGraph():
                 
     def setFailedLinks(self, str_links):
         for l in str_links:
-            assert set([l[0][0], l[1][0]]) == set(["e", "c"])
-            if l[0][0] == "c":
-                l = (l[1], l[0])
-            self.lkfp.add( (int(l[0][1:]), int(l[1][1:])) )
+            self.lkfp.add(parseLink(l))
         self.replkfp = None
 
 
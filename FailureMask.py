@@ -0,0 +1,175 @@
+from __future__ import print_function
+
+from Topology import parseLink, nodeID, edgeName, coreName, linkName
+
+
+# A failure pattern packed into one integer.  Bit l (l = e*numCore + c) is
+# link (e, c), bit numLink + e is L1 switch e and bit numLink + numEdge + c
+# is L2 switch c.  Union, subset test, equality and hash are single integer
+# operations, and a pattern costs a few machine words.
+
+# key = radix, value = per-radix bit layout, see maskLayout
+maskLayouts = dict()
+
+
+def maskLayout(radix):
+    if radix in maskLayouts:
+        return maskLayouts[radix]
+    numEdge = radix
+    numCore = radix // 2
+    numLink = numEdge * numCore
+    layout = { "numEdge": numEdge,
+               "numCore": numCore,
+               "numLink": numLink,
+               "linkBits": (1 << numLink) - 1,
+               # links of each L1 and L2 switch
+               "edgeLinkBits": [((1 << numCore) - 1) << (e*numCore) for e in range(numEdge)],
+               "coreLinkBits": [sum(1 << (e*numCore + c) for e in range(numEdge)) for c in range(numCore)] }
+    maskLayouts[radix] = layout
+    return layout
+
+
+def bitIndices(bits):
+    idx = list()
+    i = 0
+    while bits:
+        if bits & 1:
+            idx.append(i)
+        bits >>= 1
+        i += 1
+    return idx
+
+
+class FailureMask(object):
+    __slots__ = ("radix", "bits")
+
+    def __init__(self, radix, links=(), l1s=(), l2s=(), bits=0):
+        layout = maskLayout(radix)
+        numCore = layout["numCore"]
+        numLink = layout["numLink"]
+        numEdge = layout["numEdge"]
+        for (e, c) in links:
+            assert 0 <= e < numEdge and 0 <= c < numCore, "Invalid failed link {0}".format((e, c))
+            bits |= 1 << (e*numCore + c)
+        for e in l1s:
+            assert 0 <= e < numEdge, "Invalid L1 node {0}".format(e)
+            bits |= 1 << (numLink + e)
+        for c in l2s:
+            assert 0 <= c < numCore, "Invalid L2 node {0}".format(c)
+            bits |= 1 << (numLink + numEdge + c)
+        self.radix = radix
+        self.bits = bits
+
+    def __reduce__(self):
+        return (FailureMask, (self.radix, (), (), (), self.bits))
+
+    def __eq__(self, other):
+        return isinstance(other, FailureMask) and self.radix == other.radix and self.bits == other.bits
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.radix, self.bits))
+
+    def __or__(self, other):
+        return self.union(other)
+
+    def __le__(self, other):
+        return self.issubset(other)
+
+    def __len__(self):
+        return bin(self.bits).count("1")
+
+    def __repr__(self):
+        return "FailureMask({0}, links={1}, l1s={2}, l2s={3})".format(
+            self.radix, self.links(), self.l1s(), self.l2s())
+
+    def union(self, other):
+        assert self.radix == other.radix
+        return FailureMask(self.radix, bits=self.bits | other.bits)
+
+    def issubset(self, other):
+        assert self.radix == other.radix
+        return self.bits & ~other.bits == 0
+
+    def linkBits(self):
+        return self.bits & maskLayout(self.radix)["linkBits"]
+
+    def l1Bits(self):
+        layout = maskLayout(self.radix)
+        return (self.bits >> layout["numLink"]) & ((1 << layout["numEdge"]) - 1)
+
+    def l2Bits(self):
+        layout = maskLayout(self.radix)
+        return self.bits >> (layout["numLink"] + layout["numEdge"])
+
+    # Link-only pattern, i.e. without node failures
+    def linkMask(self):
+        return FailureMask(self.radix, bits=self.linkBits())
+
+    def links(self):
+        numCore = maskLayout(self.radix)["numCore"]
+        return tuple((l // numCore, l % numCore) for l in bitIndices(self.linkBits()))
+
+    def l1s(self):
+        return tuple(bitIndices(self.l1Bits()))
+
+    def l2s(self):
+        return tuple(bitIndices(self.l2Bits()))
+
+    # Link bits of every link that is down, including links of failed switches
+    def allFailedLinkBits(self):
+        layout = maskLayout(self.radix)
+        bits = self.linkBits()
+        for e in self.l1s():
+            bits |= layout["edgeLinkBits"][e]
+        for c in self.l2s():
+            bits |= layout["coreLinkBits"][c]
+        return bits
+
+    # (L2-FP, L1-FP, LK-FP) with string node names
+    def toNames(self):
+        return (set(coreName(c) for c in self.l2s()),
+                set(edgeName(e) for e in self.l1s()),
+                tuple(linkName(e, c) for (e, c) in self.links()))
+
+
+def maskFromNames(radix, l2fp=(), l1fp=(), linkfp=()):
+    return FailureMask(radix,
+                       links=[parseLink(l) for l in linkfp],
+                       l1s=[nodeID(e) for e in l1fp],
+                       l2s=[nodeID(c) for c in l2fp])
+
+
+def test_FailureMask():
+    radix = 8
+    a = FailureMask(radix, links=[(0, 1), (7, 3)])
+    b = FailureMask(radix, links=[(0, 1)], l1s=[2])
+    c = FailureMask(radix, l2s=[3])
+    assert a.links() == ((0, 1), (7, 3))
+    assert b.l1s() == (2,) and c.l2s() == (3,)
+    assert len(a | b) == 3
+    assert (a | b).links() == ((0, 1), (7, 3)) and (a | b).l1s() == (2,)
+    assert FailureMask(radix, links=[(0, 1)]) <= a and not a <= b
+    assert a == FailureMask(radix, links=[(7, 3), (0, 1)])
+    assert len(set([a, b, FailureMask(radix, links=[(7, 3), (0, 1)])])) == 2
+
+    names = (set(["c3"]), set(["e2"]), (("e0", "c1"), ("e7", "c3")))
+    m = maskFromNames(radix, *names)
+    assert m == (a | b | c).union(FailureMask(radix)) and m.toNames() == names
+    assert maskFromNames(radix, linkfp=[("c1", "e0")]) == FailureMask(radix, links=[(0, 1)])
+
+    # Node failures take every adjacent link down
+    numCore = radix // 2
+    bits = (b | c).allFailedLinkBits()
+    expect = set([(0, 1)] + [(2, ci) for ci in range(numCore)] + [(e, 3) for e in range(radix)])
+    assert set((l // numCore, l % numCore) for l in bitIndices(bits)) == expect
+
+    import pickle
+    assert pickle.loads(pickle.dumps(m)) == m
+    print("FailureMask passed")
+
+
+if __name__ == "__main__":
+    test_FailureMask()
@@ -0,0 +1,209 @@
+from __future__ import print_function
+import time
+import pickle
+import traceback
+import multiprocessing as mp
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from Solver import getBackend
+from Router import Router
+from FailureMask import FailureMask
+from ExtremeTraffic import load_PrunedETM
+from Wiring import load_Wiring
+from LinkFailurePattern import iterRepLinkFP
+from L1FailurePattern import getL1FP
+from CapacityVerification import CapacityModel, verificationRouter
+from Profiling import flushCounters
+
+
+# Per-process state of a sweep worker, filled once by initSweepWorker
+sweepWorker = dict()
+
+
+def initSweepWorker(radix, M, algo, mode, threshold, solver):
+    wiring = load_Wiring(M, algo)
+    etms = load_PrunedETM(M, "Capacity")
+    if mode == "Joint":
+        numTM = len(etms)
+    else:
+        numTM = 1
+
+    backend = getBackend(solver)
+
+    sweepWorker["backend"] = backend
+    sweepWorker["router"] = Router(radix)
+    sweepWorker["scenario"] = { "router": sweepWorker["router"],
+                                "wiring": wiring,
+                                "M": M,
+                                "etms": etms,
+                                "mode": mode,
+                                "threshold": threshold,
+                                "model": CapacityModel(radix, wiring, numTM, backend) }
+
+
+# Returns (batch ID, results, error).  Python 2 pools have no error_callback,
+# so a failure is caught here and handed back with the batch, which keeps
+# the parent from waiting on a batch that never completes.  Pool workers
+# exit without atexit handlers, so counters are flushed after every batch.
+def verifySweepScenarios(batchId, batch):
+    try:
+        return (batchId, verifySweepBatch(batch), None)
+    except Exception as e:
+        error = (e, traceback.format_exc())
+        try:
+            pickle.dumps(error)
+        except Exception:
+            error = (RuntimeError(repr(e)), error[1])
+        return (batchId, None, error)
+    finally:
+        flushCounters()
+
+
+def verifySweepBatch(batch):
+    scenario = sweepWorker["scenario"]
+    router = sweepWorker["router"]
+    capModel = scenario["model"]
+    results = list()
+    for fps in batch:
+        if isinstance(fps, FailureMask):
+            router.setFailureMask(fps)
+        else:
+            (l2fp, l1fp, linkfp) = fps
+            router.setL2Failure(l2fp)
+            router.setL1Failure(l1fp)
+            router.setLinkFailure(linkfp)
+        t = time.time()
+        numSolve = capModel.numSolve
+        result = verificationRouter(scenario)
+        meta = { "mode": scenario["mode"],
+                 "time": time.time() - t,
+                 "numSolve": capModel.numSolve - numSolve }
+        results.append((result, meta))
+    return results
+
+
+# Link failure patterns may be a stream (e.g. FailurePattern.iterRepresentatives),
+# so they are the outer loop and read once
+def crossScenarios(l2fps, l1fps, linkfps):
+    l2fps = list(l2fps)
+    l1fps = list(l1fps)
+    for linkfp in linkfps:
+        for l2fp in l2fps:
+            for l1fp in l1fps:
+                yield (l2fp, l1fp, linkfp)
+
+
+# Shard scenarios, i.e. (L2-FP, L1-FP, LK-FP) tuples or FailureMasks, across a process pool.
+# Every worker loads the wiring and ETMs once and keeps one solver backend
+# (e.g. one Gurobi environment) and capacity model for all of its scenarios.  Results are
+# yielded as (L2-FP, L1-FP, LK-FP, beta), or (mask, beta), in completion order.  With a
+# threshold, beta is replaced by verificationRouter's (pass, ETM index, beta).
+# A VerificationCache is consulted and filled in this process only, so cached
+# scenarios never reach the pool.
+def sweepRouter(radix, M, algo, scenarios, numWorker=None, mode="PerETM", chunksize=1, threshold=None, cache=None, solver=None):
+    if numWorker is None:
+        numWorker = mp.cpu_count()
+    if cache is not None:
+        wiring = load_Wiring(M, algo)
+        etms = load_PrunedETM(M, "Capacity")
+    # A pool whose initializer fails restarts its workers forever, so make
+    # sure the backend starts before any worker tries it
+    getBackend(solver)
+
+    pool = mp.Pool(numWorker, initSweepWorker, (radix, M, algo, mode, threshold, solver))
+    done = queue.Queue()
+    pending = dict() # key = batch ID, value = (scenarios, cache keys)
+    try:
+        batch = list()
+        keys = list()
+        for fps in scenarios:
+            if cache is not None:
+                if isinstance(fps, FailureMask):
+                    key = cache.maskKey(radix, wiring, M, etms, fps)
+                else:
+                    key = cache.scenarioKey(radix, wiring, M, etms, fps[0], fps[1], fps[2])
+                result = cache.lookup(key, threshold)
+                if result is not None:
+                    yield scenarioResult(fps, result)
+                    continue
+                keys.append(key)
+            batch.append(fps)
+            if len(batch) < chunksize:
+                continue
+
+            # Keep a bounded number of batches in flight
+            while len(pending) >= 2 * numWorker:
+                for r in collectSweepResults(done, pending, cache, threshold):
+                    yield r
+            submitSweepBatch(pool, done, pending, batch, keys)
+            batch = list()
+            keys = list()
+
+        if len(batch) > 0:
+            submitSweepBatch(pool, done, pending, batch, keys)
+        while len(pending) > 0:
+            for r in collectSweepResults(done, pending, cache, threshold):
+                yield r
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def submitSweepBatch(pool, done, pending, batch, keys):
+    batchId = len(pending)
+    while batchId in pending:
+        batchId += 1
+    pending[batchId] = (batch, keys)
+    pool.apply_async(verifySweepScenarios, (batchId, batch), callback=done.put)
+
+
+def collectSweepResults(done, pending, cache, threshold):
+    (batchId, results, error) = done.get()
+    (batch, keys) = pending.pop(batchId)
+    if error is not None:
+        (e, tb) = error
+        print("Sweep worker failed on batch", batchId, ":\n" + tb)
+        raise e
+    for i in range(len(batch)):
+        (result, meta) = results[i]
+        if cache is not None:
+            cache.store(keys[i], result, threshold, meta)
+        yield scenarioResult(batch[i], result)
+
+
+def scenarioResult(fps, result):
+    if isinstance(fps, FailureMask):
+        return (fps, result)
+    return tuple(fps) + (result,)
+
+
+def parallelTest():
+    radix = 4
+    M = (2, 2, 4)
+    algo = "Optimal"
+    numL2Failure = 0
+    numL1Failure = 0
+    numLinkFailure = 1
+    numWorker = mp.cpu_count()
+
+    wiring = load_Wiring(M, algo)
+    l2fps = [set(["c"+str(ci) for ci in range(numL2Failure)])]
+    l1fps = getL1FP(wiring, numL1Failure)
+    linkfps = iterRepLinkFP(radix, M, numLinkFailure, algo)
+
+    dt = time.time()
+    numScenario = 0
+    scenarios = crossScenarios(l2fps, l1fps, linkfps)
+    for (l2fp, l1fp, linkfp, beta) in sweepRouter(radix, M, algo, scenarios, numWorker):
+        numScenario += 1
+        print("Beta =", beta, ": L2-FP =", l2fp, ", L1-FP =", l1fp, ", LK-FP =", linkfp)
+    dt = time.time() - dt
+    print(numScenario, "scenarios on", numWorker, "workers in", dt, "sec.")
+
+
+if __name__ == "__main__":
+    parallelTest()
@@ -4,14 +4,15 @@ import pickle
 
 from ExtremeTraffic import load_ETM
 from Wiring import load_Wiring
+from Profiling import profiled
 
 
 def deriveSubgroup(wiring):
     groups = dict()
     gkeys = dict()
-    for eid in xrange(len(wiring)):
+    for eid in range(len(wiring)):
         we = wiring[eid]
-        if not groups.has_key(we):
+        if we not in groups:
             gkeys[len(groups)] = we
             groups[we] = list()
         groups[we].append(eid)
@@ -21,11 +22,11 @@ def deriveSubgroup(wiring):
 def getL1FailurePatterns(groups, gkeys, numFailure):
     numGroup = len(groups)
     comb = [[]]
-    for gid in xrange(numGroup):
+    for gid in range(numGroup):
         tgid = list()
         gk = gkeys[gid]
         for c in comb:
-            for n in xrange(len(groups[gk])+1):
+            for n in range(len(groups[gk])+1):
                 tc = c[:]
                 tc.append(n)
                 if sum(tc) <= numFailure:
@@ -39,13 +40,14 @@ def getL1FailurePatterns(groups, gkeys, numFailure):
     return fps
 
 
+@profiled("getL1FP")
 def getL1FP(wiring, numFailure):
     (groups, gkeys) = deriveSubgroup(wiring)
     dists = getL1FailurePatterns(groups, gkeys, numFailure)
     fps = set()
     for dist in dists:
         fp = list()
-        for gid in xrange(len(groups)):
+        for gid in range(len(groups)):
             gk = gkeys[gid]
             for i in range(dist[gid]):
                 fp.append("e"+str(groups[gk][i]))
@@ -1,11 +1,16 @@
 from __future__ import print_function
 import itertools
-import copy
 import time
 import numpy as np
-import pickle
+import json
+import os
+import multiprocessing as mp
 
 from Wiring import load_Wiring, getBaselineWiring
+from Topology import Topology, parseLink, linkName, nodeID, edgeName, coreName
+from FailureMask import FailureMask
+from Profiling import profiled, flushCounters
+from Compat import loadPickle, savePickle
 
 LinkFPSaveDir = "LKFP-save"
 
@@ -17,34 +22,177 @@ def defaultRepLinkFPFilename(M, numFailure, algo):
     return fname + "-" + str(numFailure) + "-" + algo
 
 
+@profiled("load_RepLinkFP")
 def load_RepLinkFP(M, numFailure, algo):
     fname = defaultRepLinkFPFilename(M, numFailure, algo)
     fullpath = LinkFPSaveDir + "/" + fname
-    fpsFile = open(fullpath, "r")
-    fps = pickle.load(fpsFile)
-    fpsFile.close()
+    fps = loadPickle(fullpath)
     return fps
 
 
+@profiled("save_RepLinkFP")
 def save_RepLinkFP(rfps, M, numFailure, algo):
     fname = defaultRepLinkFPFilename(M, numFailure, algo)
     fullpath = LinkFPSaveDir + "/" + fname
-    fpsFile = open(fullpath, "w")
-    pickle.dump(rfps, fpsFile)
-    fpsFile.close()
+    savePickle(rfps, fullpath)
     print("Save result to", fullpath)
 
 
+# Binary representatives: one .npy per failure count whose rows are the
+# failed-link bitmasks (bit e*numCore + c, see FailureMask) packed into
+# bytes, plus a JSON index with the radix, row width and row count per
+# failure count.  Rows are memory-mapped on load, so a slice only reads
+# its own rows.
+def binaryRepLinkFPFilename(M, numFailure, algo):
+    return defaultRepLinkFPFilename(M, numFailure, algo) + ".npy"
+
+
+def binaryIndexRepLinkFPFilename(M, algo):
+    fname = "RLKFP"
+    for m in M:
+        fname += "_" + str(m)
+    return fname + "-" + algo + "-index.json"
+
+
+def packRepLinkFP(fps, radix):
+    numCore = radix // 2
+    bits = np.zeros((len(fps), radix * numCore), dtype=bool)
+    for row in range(len(fps)):
+        for (e, c) in fps[row]:
+            bits[row, e*numCore + c] = True
+    return np.packbits(bits, axis=1)
+
+
+def unpackRepLinkFP(rows, radix):
+    numCore = radix // 2
+    bits = np.unpackbits(np.asarray(rows, dtype=np.uint8), axis=1)[:, :radix * numCore]
+    fps = list()
+    for row in bits:
+        fps.append(tuple((int(l) // numCore, int(l) % numCore) for l in np.nonzero(row)[0]))
+    return fps
+
+
+@profiled("load_RepLinkFPIndex")
+def load_RepLinkFPIndex(M, algo):
+    fullpath = LinkFPSaveDir + "/" + binaryIndexRepLinkFPFilename(M, algo)
+    if not os.path.exists(fullpath):
+        return None
+    indexFile = open(fullpath, "r")
+    index = json.load(indexFile)
+    indexFile.close()
+    return index
+
+
+# fps are tuples of (edge ID, core ID) links
+@profiled("save_RepLinkFPBinary")
+def save_RepLinkFPBinary(fps, radix, M, numFailure, algo):
+    rows = packRepLinkFP(list(fps), radix)
+    fullpath = LinkFPSaveDir + "/" + binaryRepLinkFPFilename(M, numFailure, algo)
+    np.save(fullpath, rows)
+
+    index = load_RepLinkFPIndex(M, algo)
+    if index is None:
+        index = { "radix": radix, "numLink": radix * (radix // 2), "rowBytes": int(rows.shape[1]), "counts": dict() }
+    assert index["radix"] == radix
+    index["counts"][str(numFailure)] = int(rows.shape[0])
+    indexFile = open(LinkFPSaveDir + "/" + binaryIndexRepLinkFPFilename(M, algo), "w")
+    json.dump(index, indexFile, sort_keys=True)
+    indexFile.close()
+    print("Save result to", fullpath)
+
+
+# Memory-mapped (numPattern, rowBytes) uint8 array of packed patterns
+@profiled("load_RepLinkFPBinary")
+def load_RepLinkFPBinary(M, numFailure, algo):
+    fullpath = LinkFPSaveDir + "/" + binaryRepLinkFPFilename(M, numFailure, algo)
+    return np.load(fullpath, mmap_mode="r")
+
+
+# String patterns of rows [start, stop) of a binary file
+def iterRepLinkFPBinary(M, numFailure, algo, start=0, stop=None, blockSize=4096):
+    index = load_RepLinkFPIndex(M, algo)
+    rows = load_RepLinkFPBinary(M, numFailure, algo)
+    if stop is None:
+        stop = rows.shape[0]
+    for blockStart in range(start, stop, blockSize):
+        for fp in unpackRepLinkFP(rows[blockStart:min(stop, blockStart + blockSize)], index["radix"]):
+            yield IntFPtoStrFP(fp)
+
+
+# Sharded representatives: shard i of a failure count holds the canonical
+# descendants of the i-th canonical prefix pattern, the JSON index records
+# the number of shards, patterns per shard and the shard file format
+def shardRepLinkFPFilename(M, numFailure, algo, shardId):
+    return defaultRepLinkFPFilename(M, numFailure, algo) + "-Shard_" + str(shardId)
+
+
+def shardIndexRepLinkFPFilename(M, numFailure, algo):
+    return defaultRepLinkFPFilename(M, numFailure, algo) + "-Shards.json"
+
+
+@profiled("load_RepLinkFPShard")
+def load_RepLinkFPShard(M, numFailure, algo, shardId):
+    fullpath = LinkFPSaveDir + "/" + shardRepLinkFPFilename(M, numFailure, algo, shardId)
+    index = load_RepLinkFPShardIndex(M, numFailure, algo)
+    if index.get("format", "pickle") == "npy":
+        rows = np.load(fullpath + ".npy", mmap_mode="r")
+        return set(IntFPtoStrFP(fp) for fp in unpackRepLinkFP(rows, index["radix"]))
+    fps = loadPickle(fullpath)
+    return fps
+
+
+@profiled("save_RepLinkFPShard")
+def save_RepLinkFPShard(rfps, M, numFailure, algo, shardId):
+    fullpath = LinkFPSaveDir + "/" + shardRepLinkFPFilename(M, numFailure, algo, shardId)
+    if isinstance(rfps, np.ndarray):
+        np.save(fullpath + ".npy", rfps)
+        return
+    savePickle(rfps, fullpath)
+
+
+# Indices pickled by older versions, without the .json suffix, are still read
+@profiled("load_RepLinkFPShardIndex")
+def load_RepLinkFPShardIndex(M, numFailure, algo):
+    fullpath = LinkFPSaveDir + "/" + shardIndexRepLinkFPFilename(M, numFailure, algo)
+    if not os.path.exists(fullpath):
+        return loadPickle(fullpath[:-len(".json")])
+    indexFile = open(fullpath, "r")
+    index = json.load(indexFile)
+    indexFile.close()
+    return index
+
+
+@profiled("save_RepLinkFPShardIndex")
+def save_RepLinkFPShardIndex(index, M, numFailure, algo):
+    fullpath = LinkFPSaveDir + "/" + shardIndexRepLinkFPFilename(M, numFailure, algo)
+    indexFile = open(fullpath, "w")
+    json.dump(index, indexFile, sort_keys=True)
+    indexFile.close()
+    print("Save result to", fullpath)
+
+
+# Patterns of the given shards (all by default), one shard in memory at a time
+def iterRepLinkFPShards(M, numFailure, algo, shardIds=None):
+    index = load_RepLinkFPShardIndex(M, numFailure, algo)
+    if shardIds is None:
+        shardIds = range(index["numShard"])
+    for shardId in shardIds:
+        if index["counts"][shardId] == 0:
+            continue
+        for fp in load_RepLinkFPShard(M, numFailure, algo, shardId):
+            yield fp
+
+
 class FailurePattern():
     def __init__(self, radix, wiring):
-        self.wiring = tuple([tuple(ew) for ew in wiring])
+        # L1 groups and slots come from the topology of the wiring
+        self.topology = Topology(radix, wiring)
+        self.wiring = self.topology.wiring
+        self.radix = radix
         self.numEdge = radix
-        self.numIntf = radix/2
-        self.numCore = radix/2
+        self.numIntf = radix // 2
+        self.numCore = radix // 2
 
-        self.L1gs = None
-        self.L1gsKey = None
-        self.L2gs = None
         self.numFailure = None        
         self.L1FailureGroups = None
         self.L1FailureSubPatternTemplate = None
@@ -53,36 +201,15 @@ class FailurePattern():
         self.L2FailurePatterns = None
         self.FailurePatterns = None
 
-        self.__decomposeComponent()
-
         
-    def __decomposeComponent(self):
-        # L1 groups
-        wiring = self.wiring
-        L1gs = dict()
-        L1gsKey = list()
-        for e in xrange(len(wiring)):
-            we = wiring[e]
-            if not L1gs.has_key(we):
-                L1gs[we] = list()
-                L1gsKey.append(we)
-            edgeID = e
-            L1gs[we].append(edgeID)
-        self.L1gs = L1gs
-        self.L1gsKey = L1gsKey
-
-        # L2 groups
-        self.L2gs = tuple([c for c in xrange(self.numCore)])
-
-
     def __recurCreateL1FailureGroups(self, remainFailure, fg):
-        if len(fg) == len(self.L1gs):
+        if len(fg) == self.topology.numGroup:
             if remainFailure == 0:
                 self.L1FailureGroups.append(tuple(fg))
             return
 
-        curGroupKey = self.L1gsKey[len(fg)]
-        for i in xrange(min(self.numIntf * len(self.L1gs[curGroupKey]), remainFailure) + 1):
+        numNode = len(self.topology.edgeGroups[len(fg)])
+        for i in range(min(self.numIntf * numNode, remainFailure) + 1):
             tfg = fg[:]
             tfg.append(i)
             self.__recurCreateL1FailureGroups(remainFailure-i, tfg)
@@ -98,7 +225,7 @@ class FailurePattern():
         prvFailureCnt = float("inf")
         if len(fe) > 0:
             prvFailureCnt = fe[-1]
-        for i in xrange(min([prvFailureCnt, self.numIntf, remainFailure]), -1, -1):
+        for i in range(min([prvFailureCnt, self.numIntf, remainFailure]), -1, -1):
             tfe = fe[:]
             tfe.append(i)
             self.__recurGenL1FailureSubPatternTemplate(totEdge, totFailure, remainFailure-i, tfe)
@@ -113,12 +240,11 @@ class FailurePattern():
     def __genL1FailureSubPatternTemplate(self):
         self.L1FailureSubPatternTemplate = dict()
         for fg in self.L1FailureGroups:
-            for i in xrange(len(fg)):
-                curGroupKey = self.L1gsKey[i]
-                totEdge = len(self.L1gs[curGroupKey])
+            for i in range(len(fg)):
+                totEdge = len(self.topology.edgeGroups[i])
                 totFailure = fg[i]
                 tempat = (totEdge, totFailure)
-                if not self.L1FailureSubPatternTemplate.has_key(tempat):
+                if tempat not in self.L1FailureSubPatternTemplate:
                     self.L1FailureSubPatternTemplate[tempat] = list()
                     self.__recurGenL1FailureSubPatternTemplate(totEdge, totFailure, totFailure, list())
                     self.L1FailureSubPatternTemplate[tempat] = tuple(self.L1FailureSubPatternTemplate[tempat])
@@ -134,9 +260,9 @@ class FailurePattern():
             l1s = dict()
             l1subpats = dict()
 
-            for si in xrange(numSubGroup):
+            for si in range(numSubGroup):
                 l1s[si] = dict()
-                nodes = self.L1gs[self.L1gsKey[si]]
+                nodes = self.topology.edgeGroups[si]
                 numSubL1 = fg[si]                
                 subpat = (len(nodes), numSubL1)                
                 l1subpats[si] = self.L1FailureSubPatternTemplate[subpat]
@@ -148,18 +274,19 @@ class FailurePattern():
             # print("\t L1 nodes", l1s)
 
             l1pats = { tuple(): list() }
-            for si in xrange(numSubGroup):
-                tl1pats = copy.deepcopy(l1pats)
+            for si in range(numSubGroup):
+                # Partial patterns are never modified, extend them in place
+                tl1pats = l1pats
                 l1pats = dict()
-                for pat, patnodes in tl1pats.iteritems():
+                for pat, patnodes in tl1pats.items():
                     for l1sp in l1subpats[si]:
                         p = list(pat)
                         p.append(l1sp)
                         nodes = l1s[si][l1sp]
                         t = list()
                         t.extend(patnodes)
-                        for i in xrange(len(l1sp)):
-                            for rep in xrange(l1sp[i]):
+                        for i in range(len(l1sp)):
+                            for rep in range(l1sp[i]):
                                 t.append([nodes[i], None])
                         l1pats[tuple(p)] = tuple(t)
 
@@ -170,7 +297,7 @@ class FailurePattern():
 
     def __genL2FailureSubPatternTemplate(self):
         self.L2FailureSubPatternTemplate = dict()
-        for tempat, subpats in self.L1FailureSubPatternTemplate.iteritems():
+        for tempat, subpats in self.L1FailureSubPatternTemplate.items():
             # print("Template", tempat, ":", subpats)
             (numSubNode, numFailure) = tempat
             self.L2FailureSubPatternTemplate[tempat] = dict()
@@ -179,9 +306,9 @@ class FailurePattern():
                 numActSubNode = len(subpat)
                 bin = ((0,)*numActSubNode,)*self.numCore
                 bins = set([bin])
-                for pi in xrange(numActSubNode):
+                for pi in range(numActSubNode):
                     # print("\t\t Active index", pi)
-                    tbins = bins.copy()
+                    tbins = bins
                     bins = set()
                     numLink = subpat[pi]
                     perit = itertools.combinations(range(self.numCore), numLink)
@@ -207,12 +334,12 @@ class FailurePattern():
             l2subpats = dict()
             for l1dist in l1dists:
                 # print("\t L1 failure distribution", l1dist)
-                pats = set([tuple([() for x in xrange(self.numCore)])])                
-                for sgidx in xrange(len(l1dist)):
+                pats = set([tuple([() for x in range(self.numCore)])])                
+                for sgidx in range(len(l1dist)):
                     # print("\t\t L1 index", sgidx)
-                    tpats = pats.copy()
+                    tpats = pats
                     pats = set()
-                    numNode = len(self.L1gs[self.L1gsKey[sgidx]])
+                    numNode = len(self.topology.edgeGroups[sgidx])
                     numFailure = fg[sgidx]
                     l1subpat = l1dist[sgidx]
                     l2subpats[sgidx] = list(self.L2FailureSubPatternTemplate[(numNode, numFailure)][l1subpat])
@@ -221,38 +348,34 @@ class FailurePattern():
                     for l2subpat in l2subpats[sgidx]:
                         # print("\t\t\t L2 subpat", l2subpat)
 
-                        # Create type and index to reduce duplicate
+                        # Create type and index to reduce duplicate,
+                        # typeCores[type] lists the cores of that type
                         l2type = dict()
-                        for t in l2subpat:
-                            tt = list(t)
-                            tt.sort(reverse=True)
-                            tt = tuple(tt)
-                            if not l2type.has_key(tt):
+                        typeCores = list()
+                        coreType = list()
+                        for c in range(self.numCore):
+                            tt = tuple(sorted(l2subpat[c], reverse=True))
+                            if tt not in l2type:
                                 l2type[tt] = len(l2type)
-                        used = set()
-                        
-                        iter = itertools.permutations(range(self.numCore))
-                        for it in iter:
-
-                            # Detect duplicate
-                            v = list()
-                            for i in xrange(len(it)):
-                                y = list(l2subpat[it[i]])
-                                y.sort(reverse=True)
-                                y = tuple(y)
-                                v.append(l2type[y])
-                            # print("\t\t\t\t Permutation index", it, "-->", v)
-                            if tuple(v) in used:
-                                # print("\t\t\t\t\t Skip")
-                                continue
-                            else:
-                                used.add(tuple(v))
-                            
+                                typeCores.append(list())
+                            typeCores[l2type[tt]].append(c)
+                            coreType.append(l2type[tt])
+
+                        # One arrangement per distinct type vector v, taking
+                        # the k-th core of a type for its k-th occurrence in
+                        # v, i.e. the first core permutation giving v
+                        for v in multisetPermutations(coreType):
+                            nextCore = [0] * len(typeCores)
+                            it = list()
+                            for t in v:
+                                it.append(typeCores[t][nextCore[t]])
+                                nextCore[t] += 1
+
                             # print("\t\t\t\t Permutation index", it)
                             for tpat in tpats:
                                 # print("\t\t\t\t\t init pattern", tpat)
                                 npat = [list(t) for t in tpat]
-                                for x in xrange(self.numCore):
+                                for x in range(self.numCore):
                                     npat[x].extend(l2subpat[it[x]])
                                 # print("\t\t\t\t\t npat", npat)
                                 npat.sort(reverse=True)
@@ -272,15 +395,17 @@ class FailurePattern():
                 # print("\t\t L2 failure patterns", self.L2FailurePatterns[fg][l1dist])
                 for l2pat in self.L2FailurePatterns[fg][l1dist]:
                     fp = list()
-                    for c in xrange(self.numCore):
-                        for e in xrange(self.numEdge):
+                    for c in range(self.numCore):
+                        for e in range(self.numEdge):
                             if l2pat[c][e] == 1:
-                                fp.append(("e" + str(e), "c" + str(c)))
+                                fp.append((e, c))
                     # print("\t\t\t", tuple(fp))
                     self.FailurePatterns.add(tuple(fp))
                 
 
-    def setNumFailure(self, numFailure):
+    # Failure patterns as tuples of (edge ID, core ID) links
+    @profiled("FailurePattern.setNumFailureIDs")
+    def setNumFailureIDs(self, numFailure):
         self.numFailure = numFailure
         
         self.__createL1FailureGroups()
@@ -292,25 +417,251 @@ class FailurePattern():
         self.__constructRepresentativePatterns()
         return self.FailurePatterns
 
+
+    def setNumFailure(self, numFailure):
+        return set(IntFPtoStrFP(fp) for fp in self.setNumFailureIDs(numFailure))
+
     
+    def setNumFailureMasks(self, numFailure):
+        return set(FailureMask(self.radix, fp) for fp in self.setNumFailureIDs(numFailure))
+
+
     def getRepresentative(self, fp):
-        numGroup = len(self.L1gsKey)        
-        ifp = StrFPtoIntFP(fp)
-        # print("Input faiure pattern", fp)
+        if isinstance(fp, FailureMask):
+            return self.getRepresentativeMask(fp)
+        return IntFPtoStrFP(self.getRepresentativeIDs(StrFPtoIntFP(fp)))
+
+
+    # Only link failures are canonicalized, the mask must not fail switches
+    def getRepresentativeMask(self, mask):
+        assert mask.bits == mask.linkBits(), "Switch failures have no link representative"
+        return FailureMask(self.radix, self.getRepresentativeIDs(mask.links()))
+
+
+    # Lexicographically largest image of the slot x core failure matrix,
+    # row by row, under permutations of L1 switches within their group and
+    # of all L2 switches.  Each search state is the multiset of rows still
+    # to place per group and the ordered partition of the L2 switches fixed
+    # by the rows placed so far.  With a target, only check that the target
+    # itself is the largest image, i.e. canonical.
+    # part is the initial ordered partition of the columns, by default one
+    # cell of all L2 switches; columns only move within their cell.
+    def __canonicalSearch(self, rows, target=None, part=None):
+        numGroup = self.topology.numGroup
+        slotGroup = self.topology.slotGroup
+        if part is None:
+            part = (tuple(range(self.numCore)),)
+        # Empty rows always come last within their group, keep the others
+        remain = [list() for gid in range(numGroup)]
+        for s in range(self.numEdge):
+            if len(rows[s]) > 0:
+                remain[slotGroup[s]].append(tuple(sorted(rows[s])))
+        remain = tuple(tuple(sorted(grp)) for grp in remain)
+        states = set([(remain, part)])
+        numRemain = [len(grp) for grp in remain]
+
+        image = list()
+        zeroCode = (0,) * sum(len(cell) for cell in part)
+        for s in range(self.numEdge):
+            gid = slotGroup[s]
+            if numRemain[gid] == 0:
+                if target is not None and target[s] != zeroCode:
+                    return False
+                image.append(zeroCode)
+                continue
+            numRemain[gid] -= 1
+            best = None
+            nextStates = set()
+            for (remain, part) in states:
+                grp = remain[gid]
+                for row in set(grp):
+                    rowSet = set(row)
+                    code = list()
+                    newPart = list()
+                    for cell in part:
+                        ones = tuple(c for c in cell if c in rowSet)
+                        zeros = tuple(c for c in cell if c not in rowSet)
+                        code.extend([1]*len(ones) + [0]*len(zeros))
+                        if len(ones) > 0:
+                            newPart.append(ones)
+                        if len(zeros) > 0:
+                            newPart.append(zeros)
+                    code = tuple(code)
+                    if best is None or code > best:
+                        best = code
+                        nextStates = set()
+                    if code == best:
+                        ngrp = list(grp)
+                        ngrp.remove(row)
+                        nremain = remain[:gid] + (tuple(ngrp),) + remain[gid+1:]
+                        nextStates.add((nremain, tuple(newPart)))
+            if target is not None:
+                if best != target[s]:
+                    return False
+            image.append(best)
+            states = nextStates
+        if target is not None:
+            return True
+        return image
+
+
+    def __isCanonical(self, rows):
+        target = [tuple(int(c in rows[s]) for c in range(self.numCore)) for s in range(self.numEdge)]
+        return self.__canonicalSearch(rows, target)
+
+
+    def __slotRowsToIDs(self, rows):
+        fp = list()
+        for s in range(self.numEdge):
+            for c in rows[s]:
+                fp.append((self.topology.slotEdge[s], c))
+        fp.sort()
+        return tuple(fp)
+
+
+    # Canonical form of a failure pattern, equal for exactly the patterns in
+    # the same orbit under L1 group and L2 switch permutations
+    def getCanonicalIDs(self, ifp):
+        rows = [set() for s in range(self.numEdge)]
+        for (e, c) in ifp:
+            rows[self.topology.edgeSlot[e]].add(c)
+        image = self.__canonicalSearch(rows)
+        return self.__slotRowsToIDs([[c for c in range(self.numCore) if code[c]] for code in image])
+
+
+    def getCanonical(self, fp):
+        if isinstance(fp, FailureMask):
+            assert fp.bits == fp.linkBits(), "Switch failures have no link representative"
+            return FailureMask(self.radix, self.getCanonicalIDs(fp.links()))
+        return IntFPtoStrFP(self.getCanonicalIDs(StrFPtoIntFP(fp)))
+
+
+    # Canonical form of a whole scenario of failed L2 switches, L1 switches
+    # and links, equal for exactly the scenarios in the same orbit.  Links
+    # of failed switches are down anyway and are dropped.  An extra column
+    # marks failed L1 switches, and it and the failed L2 switches lead the
+    # column order, so the search only maps failed switches onto failed
+    # switches.  Returns (L2 IDs, L1 IDs, link IDs).
+    def getCanonicalScenarioIDs(self, l2ids, l1ids, linkids):
+        l2ids = set(l2ids)
+        l1ids = set(l1ids)
+        rows = [set() for s in range(self.numEdge)]
+        for (e, c) in linkids:
+            if e not in l1ids and c not in l2ids:
+                rows[self.topology.edgeSlot[e]].add(c)
+        for e in l1ids:
+            rows[self.topology.edgeSlot[e]].add(self.numCore)
+        failedCores = tuple(sorted(l2ids))
+        liveCores = tuple(c for c in range(self.numCore) if c not in l2ids)
+        part = tuple(cell for cell in ((self.numCore,), failedCores, liveCores) if len(cell) > 0)
+        image = self.__canonicalSearch(rows, part=part)
+
+        l1 = list()
+        links = list()
+        for s in range(self.numEdge):
+            e = self.topology.slotEdge[s]
+            if image[s][0]:
+                l1.append(e)
+            for c in range(self.numCore):
+                if image[s][1+c]:
+                    links.append((e, c))
+        return (tuple(range(len(failedCores))), tuple(sorted(l1)), tuple(sorted(links)))
+
+
+    def getCanonicalScenario(self, l2fp, l1fp, linkfp):
+        (l2, l1, links) = self.getCanonicalScenarioIDs([nodeID(c) for c in l2fp],
+                                                       [nodeID(e) for e in l1fp],
+                                                       StrFPtoIntFP(linkfp))
+        return (tuple(coreName(c) for c in l2), tuple(edgeName(e) for e in l1), IntFPtoStrFP(links))
+
+
+    # Streaming counterparts of setNumFailure: representative patterns are
+    # yielded one at a time and only the current branch of the orderly
+    # generation is kept in memory
+    def iterRepresentativeIDs(self, numFailure):
+        return self.iterCanonicalIDs(numFailure)
+
+
+    def iterRepresentatives(self, numFailure):
+        for fp in self.iterCanonicalIDs(numFailure):
+            yield IntFPtoStrFP(fp)
+
+
+    def iterRepresentativeMasks(self, numFailure):
+        for fp in self.iterCanonicalIDs(numFailure):
+            yield FailureMask(self.radix, fp)
+
+
+    # Orderly generation: a pattern is canonical when its slot x core matrix
+    # is its largest image, and removing the last failed link (in slot-major
+    # order) of a canonical pattern leaves a canonical pattern.  Growing
+    # canonical patterns only past their last link therefore reaches every
+    # orbit exactly once, without a set of seen patterns.
+    def iterCanonicalIDs(self, numFailure):
+        rows = [set() for s in range(self.numEdge)]
+        for fp in self.__orderlyExtend(rows, 0, numFailure):
+            yield fp
+
+
+    # Canonical patterns with one more failed link from the canonical
+    # patterns fps of one failure count.  Every canonical pattern has a
+    # single parent, itself without its last link, so each one is yielded
+    # exactly once.
+    def extendCanonicalIDs(self, fps):
+        for fp in fps:
+            rows = [set() for s in range(self.numEdge)]
+            last = -1
+            for (e, c) in fp:
+                s = self.topology.edgeSlot[e]
+                rows[s].add(c)
+                last = max(last, s*self.numCore + c)
+            for nfp in self.__orderlyExtend(rows, last + 1, 1):
+                yield nfp
+
+
+    # (numFailure, canonical patterns) for minFailure..maxFailure, each level
+    # extended from the previous one
+    def iterCanonicalLevels(self, minFailure, maxFailure):
+        fps = list(self.iterCanonicalIDs(minFailure))
+        yield (minFailure, fps)
+        for numFailure in range(minFailure + 1, maxFailure + 1):
+            fps = list(self.extendCanonicalIDs(fps))
+            yield (numFailure, fps)
+
+
+    def __orderlyExtend(self, rows, start, remainFailure):
+        if remainFailure == 0:
+            yield self.__slotRowsToIDs(rows)
+            return
+        numPos = self.numEdge * self.numCore
+        for pos in range(start, numPos - remainFailure + 1):
+            (s, c) = divmod(pos, self.numCore)
+            # A canonical pattern never has an empty row ahead of a non-empty
+            # row of the same L1 group
+            if s > 0 and self.topology.slotGroup[s-1] == self.topology.slotGroup[s] and len(rows[s-1]) == 0:
+                continue
+            rows[s].add(c)
+            if self.__isCanonical(rows):
+                for fp in self.__orderlyExtend(rows, pos + 1, remainFailure - 1):
+                    yield fp
+            rows[s].remove(c)
+
+
+    def getRepresentativeIDs(self, ifp):
+        numGroup = self.topology.numGroup
         # print("\t Integer failure pattern", ifp)
 
         re = list()
-        for gid in xrange(numGroup):
-            k = self.L1gsKey[gid]
-            subgrouplen = len(self.L1gs[k])
+        for gid in range(numGroup):
+            subgrouplen = len(self.topology.edgeGroups[gid])
             re.append([0]*subgrouplen)
-        rc = [[0]*self.numEdge for x in xrange(self.numCore)]
+        rc = [[0]*self.numEdge for x in range(self.numCore)]
         
         for l in ifp:
             eid = l[0]
             cid = l[1]
-            gid = self.L1gsKey.index(self.wiring[eid])
-            egid = self.L1gs[self.L1gsKey[gid]].index(eid)
+            gid = self.topology.edgeGroup[eid]
+            egid = self.topology.groupPos[eid]
             re[gid][egid] += 1
             rc[cid][eid] += 1
         # print("\t Edge groups", re)
@@ -318,10 +669,10 @@ class FailurePattern():
 
         # Sort layer-1 subgroup
         offset = 0
-        newcg = [ [ [] for gid in xrange(len(re)) ] for x in xrange(self.numCore)]
+        newcg = [ [ [] for gid in range(len(re)) ] for x in range(self.numCore)]
         neweg = [None]*len(re)
         newfp = list()
-        for gid in xrange(numGroup):
+        for gid in range(numGroup):
             sg = re[gid]
             lensg = len(sg)            
             # print("subgroup:", sg)
@@ -329,7 +680,7 @@ class FailurePattern():
             # print("\t sort index", sortidx)
 
             newsg = [None] * lensg
-            for idx in xrange(lensg):
+            for idx in range(lensg):
                 ridx = lensg - idx - 1
                 pidx = sortidx[ridx]
                 newsg[idx] = sg[pidx]
@@ -348,17 +699,15 @@ class FailurePattern():
         # print("newfp:", newfp)       
 
         # Sort layer-2 subgroup
-        neweg2 = copy.deepcopy(neweg)        
-        newcg2 = copy.deepcopy(newcg)
-        newcg2.sort(reverse=True)
+        newcg2 = sorted(newcg, reverse=True)
         newfp2 = list()
         # create mapping
         map2 = dict() # key = coreid, new coreid
         dupcheck = dict() # key = newcg[x], value = last index
-        for cid in xrange(self.numCore):
+        for cid in range(self.numCore):
             code = newcg[cid]
             tcode = tuple(tuple(x) for x in newcg[cid])            
-            if dupcheck.has_key(tcode):
+            if tcode in dupcheck:
                 lastindex = dupcheck[tcode]
             else:
                 lastindex = -1
@@ -375,10 +724,10 @@ class FailurePattern():
 
         # Sort layer-1 subgroup's group
         offset = 0
-        newcg3 = [[0]*self.numEdge for x in xrange(self.numCore)]
+        newcg3 = [[0]*self.numEdge for x in range(self.numCore)]
         neweg3 = list()
         newfp3 = list()
-        for gid in xrange(numGroup):
+        for gid in range(numGroup):
             sg = neweg[gid]
             # print("gid:", gid, sg)
             begidx = 0
@@ -393,7 +742,7 @@ class FailurePattern():
                 ssgcode = list()
 
                 # Create code of level-1 switch 
-                for idx in xrange(begidx, endidx):
+                for idx in range(begidx, endidx):
                     code = [0]*self.numCore
                     for l in newfp2:
                         if l[0] != offset + idx:
@@ -403,8 +752,7 @@ class FailurePattern():
                     ssgcode.append(code)
                 # print("\t subsubgroup code", ssgcode)
 
-                tssgcode = copy.deepcopy(ssgcode)
-                tssgcode.sort(reverse=True)
+                tssgcode = sorted(ssgcode, reverse=True)
                 # print("\t sorted code", tssgcode)
 
                 # Update fp
@@ -412,10 +760,10 @@ class FailurePattern():
                 # create map3
                 map3 = dict() # key = edgeid, value = new edgeid
                 dupcheck = dict() # key = ssgcode[x], value = last index
-                for ssgid in xrange(len(ssgcode)):
+                for ssgid in range(len(ssgcode)):
                     code = ssgcode[ssgid]
                     tcode = tuple(code)
-                    if dupcheck.has_key(tcode):
+                    if tcode in dupcheck:
                         lastindex = dupcheck[tcode]
                     else:
                         lastindex = -1
@@ -438,38 +786,144 @@ class FailurePattern():
             neweg3.append(newsg)
             offset += len(sg)
         newfp3.sort()
-        return tuple([("e" + str(l[0]), "c" + str(l[1])) for l in newfp3])
+        return tuple(newfp3)
+
+
+# Distinct permutations of a multiset in lexicographic order
+def multisetPermutations(items):
+    p = sorted(items)
+    n = len(p)
+    while True:
+        yield tuple(p)
+        i = n - 2
+        while i >= 0 and p[i] >= p[i+1]:
+            i -= 1
+        if i < 0:
+            return
+        j = n - 1
+        while p[j] <= p[i]:
+            j -= 1
+        (p[i], p[j]) = (p[j], p[i])
+        p[i+1:] = reversed(p[i+1:])
 
 
 def StrFPtoIntFP(sfp):
-    ifp = list()
-    for l in sfp:
-        if l[0][0] == "e" and l[1][0] == "c":
-            pass
-        elif l[0][0] == "c" and l[1][0] == "e":
-            l = (l[1], l[0])
+    return tuple(parseLink(l) for l in sfp)
+
+
+def IntFPtoStrFP(ifp):
+    return tuple(linkName(e, c) for (e, c) in ifp)
+
+
+# Representative link failure patterns of a saved wiring, generated lazily
+# instead of loaded from LKFP-save
+def iterRepLinkFP(radix, M, numFailure, algo):
+    FP = FailurePattern(radix, load_Wiring(M, algo))
+    return FP.iterRepresentatives(numFailure)
+
+
+# fmt "pickle" saves the set of string patterns, "npy" the binary rows
+@profiled("generateRepLinkFailurePatterns")
+def generateRepLinkFailurePatterns(radix, M, algo, minFailedLink, maxFailedLink, fmt="pickle"):
+    wiring = load_Wiring(M, algo)
+    FP = FailurePattern(radix, wiring)
+
+    assert minFailedLink >= 0
+    upperboundFailure = radix**2 // 2
+    assert maxFailedLink <= upperboundFailure
+
+    for (numFailure, fps) in FP.iterCanonicalLevels(minFailedLink, maxFailedLink):
+        if fmt == "pickle":
+            repfps = set(IntFPtoStrFP(fp) for fp in fps)
+            save_RepLinkFP(repfps, M, numFailure, algo)
+        elif fmt == "npy":
+            save_RepLinkFPBinary(fps, radix, M, numFailure, algo)
         else:
-            assert False, "Invalid failure link {0}".format(str(l))
-        ifp.append((int(l[0][1:]), int(l[1][1:])))
-    return tuple(ifp)
+            assert False, "Unknown format " + str(fmt)
+
+
+def saveRepLinkFPShardLevel(fps, radix, M, numFailure, algo, shardId, fmt):
+    if len(fps) > 0 and fmt == "npy":
+        save_RepLinkFPShard(packRepLinkFP(fps, radix), M, numFailure, algo, shardId)
+    elif len(fps) > 0:
+        save_RepLinkFPShard(set(IntFPtoStrFP(fp) for fp in fps), M, numFailure, algo, shardId)
 
 
-def generateRepLinkFailurePatterns(radix, M, algo, minFailedLink, maxFailedLink):
+@profiled("generateRepLinkFPShard")
+def generateRepLinkFPShard(task):
+    (radix, M, algo, wiring, shardId, prefix, minFailedLink, maxFailedLink, fmt) = task
+    FP = FailurePattern(radix, wiring)
+    counts = dict()
+    fps = [prefix]
+    numFailure = len(prefix)
+    while True:
+        if numFailure >= minFailedLink:
+            counts[numFailure] = len(fps)
+            saveRepLinkFPShardLevel(fps, radix, M, numFailure, algo, shardId, fmt)
+        if numFailure == maxFailedLink:
+            break
+        fps = list(FP.extendCanonicalIDs(fps))
+        numFailure += 1
+    # Pool workers exit without atexit handlers
+    flushCounters()
+    return (shardId, counts)
+
+
+# Parallel generateRepLinkFailurePatterns.  The canonical patterns with
+# shardLevel failed links split the orderly generation tree into disjoint
+# subtrees, one shard each, which workers extend level by level and save
+# to per-shard files.  Only the per-shard counts come back to this process.
+# Levels below shardLevel are small and are saved here as a single shard,
+# so the number of shards does not depend on minFailedLink.
+@profiled("generateRepLinkFailurePatternsParallel")
+def generateRepLinkFailurePatternsParallel(radix, M, algo, minFailedLink, maxFailedLink, numWorker=None, shardLevel=2, fmt="pickle"):
     wiring = load_Wiring(M, algo)
     FP = FailurePattern(radix, wiring)
 
     assert minFailedLink >= 0
-    upperboundFailure = radix**2 / 2
+    upperboundFailure = radix**2 // 2
     assert maxFailedLink <= upperboundFailure
+    if numWorker is None:
+        numWorker = mp.cpu_count()
+    shardLevel = min(shardLevel, maxFailedLink)
+
+    assert fmt in ("pickle", "npy"), "Unknown format " + str(fmt)
+    counts = dict((numFailure, dict()) for numFailure in range(minFailedLink, maxFailedLink + 1))
+    for numFailure in range(minFailedLink, shardLevel):
+        fps = list(FP.iterCanonicalIDs(numFailure))
+        counts[numFailure][0] = len(fps)
+        saveRepLinkFPShardLevel(fps, radix, M, numFailure, algo, 0, fmt)
+
+    tasks = ((radix, M, algo, wiring, shardId, prefix, minFailedLink, maxFailedLink, fmt)
+             for (shardId, prefix) in enumerate(FP.iterCanonicalIDs(shardLevel)))
+    pool = mp.Pool(numWorker)
+    try:
+        for (shardId, shardCounts) in pool.imap_unordered(generateRepLinkFPShard, tasks):
+            for (numFailure, count) in shardCounts.items():
+                counts[numFailure][shardId] = count
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
 
     for numFailure in range(minFailedLink, maxFailedLink + 1):
-        t = time.time()
-        fps = FP.setNumFailure(numFailure)
-        repfps = set()
-        for fp in fps:
-            repfps.add(FP.getRepresentative(fp))
-
-        save_RepLinkFP(repfps, M, numFailure, algo)
+        numShard = len(counts[numFailure])
+        index = { "radix": radix,
+                  "format": fmt,
+                  "numShard": numShard,
+                  "counts": [counts[numFailure][shardId] for shardId in range(numShard)] }
+        save_RepLinkFPShardIndex(index, M, numFailure, algo)
+
+
+def benchmark_L2Expansion():
+    for radix in (8, 16, 32, 64):
+        M = (radix // 2, radix // 2, radix)
+        FP = FailurePattern(radix, getBaselineWiring(radix, M))
+        for numFailure in (1, 2, 3):
+            t = time.time()
+            fps = FP.setNumFailureIDs(numFailure)
+            numL2Pattern = sum(len(pats) for l2pats in FP.L2FailurePatterns.values() for pats in l2pats.values())
+            print("Radix", radix, "failures", numFailure, ":", numL2Pattern, "L2 patterns,", len(fps), "patterns in", time.time() - t, "sec.")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,214 @@
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import atexit
+import resource
+import functools
+
+# Opt-in telemetry.  With HAWR_PROFILE=<path> every stage, model build and
+# solve appends one JSON line to <path> (HAWR_PROFILE=- writes to stderr).
+# Without it the hooks return at once: stage() hands out a shared no-op
+# context and record() and count() test one global.
+ProfileTarget = os.environ.get("HAWR_PROFILE", None) or None
+
+# Output file of this process, reopened after a fork
+profileFile = None
+profilePid = None
+# key = counter name, value = count
+counters = dict()
+
+
+def enabled():
+    return ProfileTarget is not None
+
+
+def setProfileTarget(target):
+    global ProfileTarget, profileFile
+    flushCounters()
+    if profileFile is not None and profileFile is not sys.stderr:
+        profileFile.close()
+    profileFile = None
+    ProfileTarget = target
+
+
+def maxRSS():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def cpuTime():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def profileOutput():
+    global profileFile, profilePid
+    if profileFile is None or profilePid != os.getpid():
+        if ProfileTarget == "-":
+            profileFile = sys.stderr
+        else:
+            profileFile = open(ProfileTarget, "a")
+        profilePid = os.getpid()
+    return profileFile
+
+
+def record(event, **fields):
+    if ProfileTarget is None:
+        return
+    fields["event"] = event
+    fields["created"] = time.time()
+    fields["pid"] = os.getpid()
+    fp = profileOutput()
+    fp.write(json.dumps(fields, sort_keys=True, default=str) + "\n")
+    fp.flush()
+
+
+def count(name, n=1):
+    if ProfileTarget is None:
+        return
+    counters[name] = counters.get(name, 0) + n
+
+
+def flushCounters():
+    if ProfileTarget is None or len(counters) == 0:
+        return
+    record("counters", counters=dict(counters), maxrss=maxRSS())
+    counters.clear()
+
+
+atexit.register(flushCounters)
+
+
+class NullStage():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        return False
+
+    def set(self, **fields):
+        pass
+
+
+NullStageContext = NullStage()
+
+
+# Wall and CPU time of a block with the memory high-water mark at its end.
+# set() adds fields found inside the block, e.g. the size of a result.
+class Stage():
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self):
+        self.wall = time.time()
+        self.cpu = cpuTime()
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        fields = dict(self.fields)
+        fields["wall"] = time.time() - self.wall
+        fields["cpu"] = cpuTime() - self.cpu
+        fields["maxrss"] = maxRSS()
+        if excType is not None:
+            fields["error"] = excType.__name__
+        record("stage", name=self.name, **fields)
+        return False
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+
+def stage(name, **fields):
+    if ProfileTarget is None:
+        return NullStageContext
+    return Stage(name, fields)
+
+
+# Function-level stage.  The check is made per call, so setProfileTarget
+# also applies to functions decorated before it.
+def profiled(name):
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if ProfileTarget is None:
+                return func(*args, **kwargs)
+            with Stage(name, dict()):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def load_Profile(path):
+    fp = open(path, "r")
+    events = [json.loads(line) for line in fp if line.strip()]
+    fp.close()
+    return events
+
+
+# Total wall and CPU time and number of calls per stage name, and totals of
+# the solve events per backend
+def summarizeProfile(events):
+    stages = dict()
+    solves = dict()
+    for ev in events:
+        if ev["event"] == "stage":
+            s = stages.setdefault(ev["name"], { "calls": 0, "wall": 0.0, "cpu": 0.0, "maxrss": 0 })
+            s["calls"] += 1
+            s["wall"] += ev["wall"]
+            s["cpu"] += ev["cpu"]
+            s["maxrss"] = max(s["maxrss"], ev["maxrss"])
+        elif ev["event"] == "solve":
+            s = solves.setdefault(ev["backend"], { "calls": 0, "runtime": 0.0, "iterations": 0 })
+            s["calls"] += 1
+            s["runtime"] += ev["runtime"]
+            s["iterations"] += ev["iterations"]
+    return (stages, solves)
+
+
+def test_Profiling():
+    import tempfile
+    (fd, path) = tempfile.mkstemp(suffix=".jsonl")
+    os.close(fd)
+    oldTarget = ProfileTarget
+
+    setProfileTarget(None)
+    with stage("disabled") as s:
+        s.set(x=1)
+    count("disabled")
+    assert len(counters) == 0
+
+    setProfileTarget(path)
+    with stage("outer", M=(2, 2, 4)) as s:
+        s.set(numETM=3)
+    count("solve", 2)
+
+    @profiled("square")
+    def square(x):
+        return x * x
+    assert square(3) == 9
+    setProfileTarget(oldTarget)
+
+    events = load_Profile(path)
+    os.remove(path)
+    assert [ev["event"] for ev in events] == ["stage", "stage", "counters"]
+    assert events[0]["name"] == "outer" and events[0]["numETM"] == 3 and events[0]["M"] == [2, 2, 4]
+    assert events[1]["name"] == "square"
+    assert events[2]["counters"] == { "solve": 2 }
+    (stages, solves) = summarizeProfile(events)
+    assert stages["outer"]["calls"] == 1
+
+
+if __name__ == "__main__":
+    # python Profiling.py <profile.jsonl> prints the totals per stage
+    if len(sys.argv) > 1:
+        (stages, solves) = summarizeProfile(load_Profile(sys.argv[1]))
+        for name in sorted(stages, key=lambda n: -stages[n]["wall"]):
+            s = stages[name]
+            print(name, ":", s["calls"], "calls,", s["wall"], "sec. wall,", s["cpu"], "sec. CPU, maxrss", s["maxrss"])
+        for name in sorted(solves):
+            s = solves[name]
+            print(name, ":", s["calls"], "solves,", s["runtime"], "sec.,", s["iterations"], "iterations")
+    else:
+        test_Profiling()
@@ -1,11 +1,29 @@
+from Topology import Topology, parseLink, nodeID, edgeName, coreName, linkName
+from FailureMask import FailureMask
+
+
 class Router:
     def __init__(self, radix):
         self.radix = radix
-        self.numEdge = radix
-        self.numCore = radix/2
-        self.failedLinks = set()
-        self.failedL1s = set()
-        self.failedL2s = set()
+        self.topology = Topology(radix)
+        self.numEdge = self.topology.numEdge
+        self.numCore = self.topology.numCore
+        # Failures are kept as integer IDs, see Topology
+        self.failedLinkIDs = frozenset()
+        self.failedL1IDs = frozenset()
+        self.failedL2IDs = frozenset()
+
+    @property
+    def failedLinks(self):
+        return set(linkName(e, c) for (e, c) in self.failedLinkIDs)
+
+    @property
+    def failedL1s(self):
+        return set(edgeName(e) for e in self.failedL1IDs)
+
+    @property
+    def failedL2s(self):
+        return set(coreName(c) for c in self.failedL2IDs)
 
     def setLinkFailure(self, failedLinks):
         links = set()
@@ -13,18 +31,12 @@ class Router:
             if set([l[0][0], l[1][0]]) != set(['e', 'c']):
                 print("Invalid failed link", l)
                 return
-            if l[0][0] == 'e':
-                tl = (l[0], l[1])
-            else:
-                tl = (l[1], l[0])
-            if int(tl[0][1:]) < 0 or int(tl[0][1:]) > self.numEdge:
-                print("Invalid failed link", l)
-                return
-            if int(tl[1][1:]) < 0 or int(tl[1][1:]) > self.numCore:
+            (e, c) = parseLink(l)
+            if not self.topology.validEdge(e) or not self.topology.validCore(c):
                 print("Invalid failed link", l)
                 return
-            links.add(tl)
-        self.failedLinks = links
+            links.add((e, c))
+        self.failedLinkIDs = frozenset(links)
 
     def setL1Failure(self, failedL1s):
         l1s = set()
@@ -32,11 +44,11 @@ class Router:
             if e[0] != 'e':
                 print("Invalid L1 node", e)
                 return
-            if int(e[1:]) < 0 or int(e[1:]) >= self.numEdge:
+            if not self.topology.validEdge(nodeID(e)):
                 print("Invalid L1 node", e)
                 return
-            l1s.add(e)
-        self.failedL1s = l1s
+            l1s.add(nodeID(e))
+        self.failedL1IDs = frozenset(l1s)
 
     def setL2Failure(self, failedL2s):
         l2s = set()
@@ -44,20 +56,34 @@ class Router:
             if c[0] != 'c':
                 print("Invalid L2 node", c)
                 return
-            if int(c[1:]) < 0 or int(c[1:]) >= self.numCore:
+            if not self.topology.validCore(nodeID(c)):
                 print("Invalid L2 node", c)
                 return
-            l2s.add(c)
-        self.failedL2s = l2s
+            l2s.add(nodeID(c))
+        self.failedL2IDs = frozenset(l2s)
+
+    def setLinkFailureIDs(self, failedLinks):
+        self.failedLinkIDs = frozenset(failedLinks)
+
+    def setL1FailureIDs(self, failedL1s):
+        self.failedL1IDs = frozenset(failedL1s)
+
+    def setL2FailureIDs(self, failedL2s):
+        self.failedL2IDs = frozenset(failedL2s)
+
+    def setFailureMask(self, mask):
+        assert mask.radix == self.radix
+        self.failedLinkIDs = frozenset(mask.links())
+        self.failedL1IDs = frozenset(mask.l1s())
+        self.failedL2IDs = frozenset(mask.l2s())
+
+    def getFailureMask(self):
+        return FailureMask(self.radix, self.failedLinkIDs, self.failedL1IDs, self.failedL2IDs)
+
+    # Mask over link IDs of every link that is down
+    def getFailedLinkMask(self):
+        return self.topology.linkMask(self.failedLinkIDs, self.failedL1IDs, self.failedL2IDs)
 
     def getAllFailedLinks(self):
-        links = self.failedLinks.copy()
-        for c in self.failedL2s:
-            for ei in range(self.numEdge):
-                l = ("e" + str(ei), c)
-                links.add(l)
-        for e in self.failedL1s:
-            for ci in range(self.numCore):
-                l = (e, "c" + str(ci))
-                links.add(l)
-        return links
+        links = self.topology.linkIDsToLinks(self.getFailedLinkMask().nonzero()[0])
+        return set(self.topology.linksToNames(links))
@@ -0,0 +1,394 @@
+from __future__ import print_function
+import os
+import time
+import numpy as np
+import scipy.sparse as sp
+
+import Profiling
+
+
+# Linear program in matrix form over one variable vector x:
+#   min (or max) obj.x  s.t.  Aeq x = beq,  Aub x <= bub,  lb <= x <= ub
+# and x[i] integral where integer[i] is True.
+class LinearProgram():
+    def __init__(self, obj, Aeq, beq, Aub, bub, lb, ub, integer=None, maximize=False):
+        numVar = len(obj)
+        self.obj = np.asarray(obj, dtype='float64')
+        self.Aeq = sp.csr_matrix(Aeq, shape=(len(beq), numVar))
+        self.beq = np.asarray(beq, dtype='float64')
+        self.Aub = sp.csr_matrix(Aub, shape=(len(bub), numVar))
+        self.bub = np.asarray(bub, dtype='float64')
+        self.lb = np.asarray(lb, dtype='float64')
+        self.ub = np.asarray(ub, dtype='float64')
+        if integer is None:
+            integer = np.zeros(numVar, dtype=bool)
+        self.integer = np.asarray(integer, dtype=bool)
+        self.maximize = maximize
+        self.numVar = numVar
+
+
+# Row-by-row construction of a LinearProgram for models that are not built
+# from matrices directly.  Variables are integer column indices.
+class ModelBuilder():
+    def __init__(self):
+        self.lb = list()
+        self.ub = list()
+        self.integer = list()
+        self.obj = dict()
+        self.maximize = False
+        self.rows = { "=": ([], [], [], []), "<": ([], [], [], []) }
+
+
+    def addVar(self, lb=0, ub=np.inf, integer=False):
+        self.lb.append(lb)
+        self.ub.append(ub)
+        self.integer.append(integer)
+        return len(self.lb) - 1
+
+
+    def addVars(self, n, lb=0, ub=np.inf, integer=False):
+        return [self.addVar(lb, ub, integer) for i in range(n)]
+
+
+    # sense is "=", "<" (<=) or ">" (>=); returns the row index within its sense
+    def addConstr(self, cols, vals, sense, rhs):
+        vals = [float(v) for v in vals]
+        if sense == ">":
+            vals = [-v for v in vals]
+            rhs = -rhs
+            sense = "<"
+        (rowIdx, colIdx, coeffs, rhss) = self.rows[sense]
+        row = len(rhss)
+        rowIdx.extend([row] * len(cols))
+        colIdx.extend(cols)
+        coeffs.extend(vals)
+        rhss.append(float(rhs))
+        return row
+
+
+    def setObjective(self, cols, vals, maximize=False):
+        self.obj = dict(zip(cols, vals))
+        self.maximize = maximize
+
+
+    def build(self):
+        with Profiling.stage("buildModel") as stage:
+            numVar = len(self.lb)
+            obj = np.zeros(numVar)
+            for (col, val) in self.obj.items():
+                obj[col] = val
+            A = dict()
+            for sense in ("=", "<"):
+                (rowIdx, colIdx, coeffs, rhss) = self.rows[sense]
+                A[sense] = sp.csr_matrix((coeffs, (rowIdx, colIdx)), shape=(len(rhss), numVar))
+            lp = LinearProgram(obj, A["="], self.rows["="][3], A["<"], self.rows["<"][3],
+                               self.lb, self.ub, self.integer, self.maximize)
+            stage.set(**modelStats(lp))
+        return lp
+
+
+# Size of a LinearProgram for the profile
+def modelStats(lp):
+    return { "numVar": lp.numVar,
+             "numInt": int(np.count_nonzero(lp.integer)),
+             "numConstr": lp.Aeq.shape[0] + lp.Aub.shape[0],
+             "numNZ": lp.Aeq.nnz + lp.Aub.nnz }
+
+
+def recordSolve(backend, lp, sol, nodes=None):
+    Profiling.count("solve")
+    if not Profiling.enabled():
+        return
+    fields = modelStats(lp)
+    fields.update({ "backend": backend,
+                    "status": sol.status,
+                    "runtime": sol.runtime,
+                    "iterations": sol.iterations,
+                    "nodes": nodes })
+    Profiling.record("solve", **fields)
+
+
+class Solution():
+    def __init__(self, status, x=None, objVal=None, runtime=0, iterations=0):
+        self.status = status
+        self.x = x
+        self.objVal = objVal
+        self.runtime = runtime
+        self.iterations = iterations
+
+
+# Gurobi backend.  One environment is shared by every model of the backend.
+class GurobiBackend():
+    name = "Gurobi"
+
+    def __init__(self, env=None):
+        import gurobipy
+        self.gp = gurobipy
+        if env is None:
+            env = gurobipy.Env(empty=True)
+            env.setParam("OutputFlag", 0)
+            env.start()
+        self.env = env
+
+
+    def createModel(self, lp):
+        return GurobiModel(self, lp)
+
+
+class GurobiModel():
+    def __init__(self, backend, lp):
+        with Profiling.stage("createModel", backend="Gurobi", numVar=lp.numVar):
+            self.create(backend, lp)
+
+
+    def create(self, backend, lp):
+        gp = backend.gp
+        self.gp = gp
+        self.lp = lp
+        model = gp.Model(env=backend.env)
+        vtype = np.where(lp.integer, gp.GRB.INTEGER, gp.GRB.CONTINUOUS)
+        v = model.addMVar(lp.numVar, lb=lp.lb, ub=lp.ub, obj=lp.obj, vtype=vtype)
+        if lp.maximize:
+            model.ModelSense = gp.GRB.MAXIMIZE
+        else:
+            model.ModelSense = gp.GRB.MINIMIZE
+        if lp.Aeq.shape[0] > 0:
+            model.addMConstr(lp.Aeq, v, "=", lp.beq)
+        if lp.Aub.shape[0] > 0:
+            model.addMConstr(lp.Aub, v, "<", lp.bub)
+        model.update()
+
+        constrs = model.getConstrs()
+        self.model = model
+        self.vars = model.getVars()
+        self.constrs = { "=": constrs[:lp.Aeq.shape[0]],
+                         "<": constrs[lp.Aeq.shape[0]:] }
+
+
+    def setRHS(self, sense, rows, vals):
+        self.model.setAttr("RHS", [self.constrs[sense][r] for r in rows], list(vals))
+
+
+    def setCoeffs(self, sense, rows, col, vals):
+        var = self.vars[col]
+        for (r, val) in zip(rows, vals):
+            self.model.chgCoeff(self.constrs[sense][r], var, val)
+
+
+    def setBounds(self, cols, lb=None, ub=None):
+        vs = [self.vars[c] for c in cols]
+        if lb is not None:
+            self.model.setAttr("LB", vs, list(lb))
+        if ub is not None:
+            self.model.setAttr("UB", vs, list(ub))
+
+
+    def solve(self):
+        gp = self.gp
+        model = self.model
+        model.optimize()
+        if model.status == gp.GRB.Status.OPTIMAL:
+            sol = Solution("Optimal", np.array(model.getAttr("X", self.vars)), model.ObjVal,
+                           model.Runtime, model.IterCount)
+        elif model.status == gp.GRB.Status.INFEASIBLE:
+            sol = Solution("Infeasible", runtime=model.Runtime)
+        else:
+            sol = Solution("Solver Status " + str(model.status), runtime=model.Runtime)
+        nodes = None
+        if Profiling.enabled() and model.IsMIP:
+            nodes = model.NodeCount
+        recordSolve("Gurobi", self.lp, sol, nodes)
+        return sol
+
+
+# Open-source stand-in built on SciPy's HiGHS interface, for machines
+# without a Gurobi license.  Models are kept as matrices and re-solved
+# from scratch, HiGHS is not warm started through SciPy.
+class HighsBackend():
+    name = "HiGHS"
+
+    def __init__(self):
+        import scipy.optimize
+        # milp and linprog(method="highs") need scipy >= 1.9, i.e. Python 3
+        if not hasattr(scipy.optimize, "milp"):
+            raise ImportError("HiGHS needs scipy >= 1.9, found scipy " + scipy.__version__)
+        self.opt = scipy.optimize
+
+
+    def createModel(self, lp):
+        return HighsModel(self, lp)
+
+
+class HighsModel():
+    def __init__(self, backend, lp):
+        self.opt = backend.opt
+        self.lp = lp
+        self.A = { "=": lp.Aeq, "<": lp.Aub }
+        self.b = { "=": lp.beq.copy(), "<": lp.bub.copy() }
+        self.lb = lp.lb.copy()
+        self.ub = lp.ub.copy()
+        # key = (sense, col), value = dense replacement of the column
+        self.colOverride = dict()
+
+
+    def setRHS(self, sense, rows, vals):
+        self.b[sense][list(rows)] = list(vals)
+
+
+    def setCoeffs(self, sense, rows, col, vals):
+        if (sense, col) not in self.colOverride:
+            self.colOverride[sense, col] = self.A[sense][:, col].toarray().ravel()
+        self.colOverride[sense, col][list(rows)] = list(vals)
+
+
+    def setBounds(self, cols, lb=None, ub=None):
+        if lb is not None:
+            self.lb[list(cols)] = list(lb)
+        if ub is not None:
+            self.ub[list(cols)] = list(ub)
+
+
+    def matrix(self, sense):
+        A = self.A[sense]
+        cols = [col for (s, col) in self.colOverride if s == sense]
+        if len(cols) == 0:
+            return A
+        mask = np.ones(A.shape[1])
+        mask[cols] = 0
+        rows = list()
+        ocols = list()
+        vals = list()
+        for col in cols:
+            nz = np.nonzero(self.colOverride[sense, col])[0]
+            rows.extend(nz)
+            ocols.extend([col] * len(nz))
+            vals.extend(self.colOverride[sense, col][nz])
+        override = sp.csr_matrix((vals, (rows, ocols)), shape=A.shape)
+        return A.dot(sp.diags(mask)) + override
+
+
+    def solve(self):
+        lp = self.lp
+        opt = self.opt
+        obj = -lp.obj if lp.maximize else lp.obj
+        Aeq = self.matrix("=")
+        Aub = self.matrix("<")
+
+        t = time.time()
+        if np.any(lp.integer):
+            constraints = list()
+            if Aeq.shape[0] > 0:
+                constraints.append(opt.LinearConstraint(Aeq, self.b["="], self.b["="]))
+            if Aub.shape[0] > 0:
+                constraints.append(opt.LinearConstraint(Aub, -np.inf, self.b["<"]))
+            res = opt.milp(obj, constraints=constraints, integrality=lp.integer.astype(int),
+                           bounds=opt.Bounds(self.lb, self.ub))
+            iterations = 0
+            nodes = getattr(res, "mip_node_count", None)
+        else:
+            res = opt.linprog(obj,
+                              A_ub=Aub if Aub.shape[0] > 0 else None,
+                              b_ub=self.b["<"] if Aub.shape[0] > 0 else None,
+                              A_eq=Aeq if Aeq.shape[0] > 0 else None,
+                              b_eq=self.b["="] if Aeq.shape[0] > 0 else None,
+                              bounds=np.column_stack((self.lb, self.ub)), method="highs")
+            iterations = res.nit
+            nodes = None
+        runtime = time.time() - t
+
+        if res.status == 0:
+            objVal = -res.fun if lp.maximize else res.fun
+            sol = Solution("Optimal", np.array(res.x), objVal, runtime, iterations)
+        elif res.status == 2:
+            sol = Solution("Infeasible", runtime=runtime)
+        else:
+            sol = Solution("Solver Status " + str(res.status), runtime=runtime)
+        recordSolve("HiGHS", lp, sol, nodes)
+        return sol
+
+
+SolverBackends = { "Gurobi": GurobiBackend,
+                   "HiGHS": HighsBackend }
+
+
+# Backend by name, by the HAWR_SOLVER environment variable, or the first of
+# Gurobi and HiGHS that starts.  Fails when no backend can run here.
+def getBackend(name=None):
+    if name is None:
+        name = os.environ.get("HAWR_SOLVER", None)
+    if name is not None:
+        assert name in SolverBackends, "Unknown solver backend " + str(name)
+        try:
+            return SolverBackends[name]()
+        except ImportError as e:
+            assert False, "Solver backend " + name + " is unavailable: " + str(e)
+    reasons = list()
+    for name in ("Gurobi", "HiGHS"):
+        try:
+            return SolverBackends[name]()
+        except Exception as e:
+            reasons.append(name + ": " + str(e))
+    assert False, "No solver backend can run (" + "; ".join(reasons) + "); install gurobipy with a license, or scipy >= 1.9 on Python 3 for HiGHS"
+
+
+def availableBackends():
+    names = list()
+    for name in sorted(SolverBackends.keys()):
+        try:
+            SolverBackends[name]()
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+
+def test_Backends():
+    for name in availableBackends():
+        backend = getBackend(name)
+
+        # max x + y  s.t.  x + 2y <= 4,  3x + y <= 6,  x - y = 0
+        mb = ModelBuilder()
+        (x, y) = mb.addVars(2)
+        mb.addConstr([x, y], [1, 2], "<", 4)
+        mb.addConstr([x, y], [3, 1], "<", 6)
+        mb.addConstr([x, y], [1, -1], "=", 0)
+        mb.setObjective([x, y], [1, 1], maximize=True)
+        model = backend.createModel(mb.build())
+        sol = model.solve()
+        assert sol.status == "Optimal"
+        assert abs(sol.objVal - 8/3.0) < 1e-6, (name, sol.objVal)
+
+        # Persistent updates: x + 2y <= 2 and coefficient of y in row 0 -> 1
+        model.setRHS("<", [0], [2])
+        sol = model.solve()
+        assert abs(sol.objVal - 4/3.0) < 1e-6, (name, sol.objVal)
+        model.setCoeffs("<", [0], y, [1])
+        sol = model.solve()
+        assert abs(sol.objVal - 2) < 1e-6, (name, sol.objVal)
+        model.setBounds([x], ub=[0.5])
+        sol = model.solve()
+        assert abs(sol.objVal - 1) < 1e-6, (name, sol.objVal)
+
+        # min 2a + 3b  s.t.  a + b >= 3.5,  a <= 2,  a, b integer
+        mb = ModelBuilder()
+        a = mb.addVar(ub=2, integer=True)
+        b = mb.addVar(integer=True)
+        mb.addConstr([a, b], [1, 1], ">", 3.5)
+        mb.setObjective([a, b], [2, 3])
+        sol = backend.createModel(mb.build()).solve()
+        assert sol.status == "Optimal"
+        assert abs(sol.objVal - 10) < 1e-6, (name, sol.objVal)
+
+        # Infeasible: x >= 1 and x <= 0
+        mb = ModelBuilder()
+        x = mb.addVar()
+        mb.addConstr([x], [1], ">", 1)
+        mb.addConstr([x], [1], "<", 0)
+        mb.setObjective([x], [1])
+        sol = backend.createModel(mb.build()).solve()
+        assert sol.status == "Infeasible", (name, sol.status)
+        print(name, "passed")
+
+
+if __name__ == "__main__":
+    test_Backends()
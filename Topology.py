@@ -0,0 +1,113 @@
+from __future__ import print_function
+import numpy as np
+
+
+# String node names ("e0", "c1") only exist at the I/O edges.  Inside, an
+# L1 (edge) switch is its index e, an L2 (core) switch its index c, and the
+# link between them is the link ID e*numCore + c.
+
+def edgeName(e):
+    return "e" + str(e)
+
+
+def coreName(c):
+    return "c" + str(c)
+
+
+def nodeID(name):
+    return int(name[1:])
+
+
+# ("eX", "cY") or ("cY", "eX") -> (X, Y)
+def parseLink(l):
+    if l[0][0] == "e" and l[1][0] == "c":
+        return (int(l[0][1:]), int(l[1][1:]))
+    elif l[0][0] == "c" and l[1][0] == "e":
+        return (int(l[1][1:]), int(l[0][1:]))
+    assert False, "Invalid failure link {0}".format(str(l))
+
+
+def linkName(e, c):
+    return (edgeName(e), coreName(c))
+
+
+class Topology():
+    def __init__(self, radix, wiring=None):
+        self.radix = radix
+        self.numEdge = radix
+        self.numCore = radix // 2
+        self.numLink = self.numEdge * self.numCore
+
+        # linkEdge[l], linkCore[l] are the end points of link ID l
+        self.linkEdge = np.repeat(np.arange(self.numEdge), self.numCore)
+        self.linkCore = np.tile(np.arange(self.numCore), self.numEdge)
+        if wiring is not None:
+            self.setWiring(wiring)
+        else:
+            self.wiring = None
+
+
+    # L1 switches with the same wiring row are interchangeable and form a
+    # group.  Groups are numbered in order of first appearance, and slots
+    # order the L1 switches group by group, so every group occupies a
+    # contiguous range of slots.  Trunk pair k is the ordered pair
+    # (pairSrc[k], pairDst[k]) of different trunks.
+    def setWiring(self, wiring):
+        numEdge = self.numEdge
+        self.wiring = tuple(tuple(int(w) for w in we) for we in wiring)
+        self.wiringArray = np.array(self.wiring, dtype=int)
+        self.numTrunk = len(self.wiring[0])
+
+        groupOf = dict()
+        edgeGroups = list()
+        self.edgeGroup = list()
+        self.groupPos = list()
+        for e in range(numEdge):
+            we = self.wiring[e]
+            if we not in groupOf:
+                groupOf[we] = len(edgeGroups)
+                edgeGroups.append(list())
+            gid = groupOf[we]
+            self.edgeGroup.append(gid)
+            self.groupPos.append(len(edgeGroups[gid]))
+            edgeGroups[gid].append(e)
+        self.edgeGroups = tuple(tuple(grp) for grp in edgeGroups)
+        self.numGroup = len(self.edgeGroups)
+
+        self.slotEdge = tuple(e for grp in self.edgeGroups for e in grp)
+        self.slotGroup = tuple(self.edgeGroup[e] for e in self.slotEdge)
+        self.edgeSlot = [None] * numEdge
+        for s in range(numEdge):
+            self.edgeSlot[self.slotEdge[s]] = s
+
+        numTrunk = self.numTrunk
+        self.trunkPairs = tuple((ti, tj) for ti in range(numTrunk) for tj in range(numTrunk) if ti != tj)
+        self.pairSrc = np.array([ti for (ti, tj) in self.trunkPairs], dtype=int)
+        self.pairDst = np.array([tj for (ti, tj) in self.trunkPairs], dtype=int)
+
+
+    def validEdge(self, e):
+        return 0 <= e < self.numEdge
+
+
+    def validCore(self, c):
+        return 0 <= c < self.numCore
+
+
+    # Boolean mask over link IDs of the given links plus every link of the
+    # given L1 and L2 switches
+    def linkMask(self, links=(), edges=(), cores=()):
+        mask = np.zeros((self.numEdge, self.numCore), dtype=bool)
+        for (e, c) in links:
+            mask[e, c] = True
+        mask[list(edges), :] = True
+        mask[:, list(cores)] = True
+        return mask.ravel()
+
+
+    def linksToNames(self, links):
+        return tuple(linkName(e, c) for (e, c) in links)
+
+
+    def linkIDsToLinks(self, ids):
+        return tuple((int(self.linkEdge[l]), int(self.linkCore[l])) for l in ids)
@@ -0,0 +1,182 @@
+from __future__ import print_function
+import os
+import time
+import json
+import hashlib
+import sqlite3
+import numpy as np
+
+from LinkFailurePattern import FailurePattern
+from Topology import nodeID, parseLink, edgeName, coreName, linkName
+
+CacheSaveDir = "Cache-save"
+CacheFilename = "verification.db"
+
+
+def hashETMs(etms):
+    h = hashlib.sha1()
+    for etm in etms:
+        etm = np.ascontiguousarray(etm, dtype='float64')
+        h.update(str(etm.shape).encode())
+        h.update(etm.tobytes())
+    return h.hexdigest()
+
+
+# On-disk cache of verification results.  A scenario is keyed by the radix,
+# wiring, M, a hash of the ETM set and the canonical form of its L2/L1/link
+# failure patterns under the symmetries of the wiring, so symmetric
+# scenarios share one entry.  ETMs are over trunks, which the symmetries
+# keep, so a cached ETM index holds for every scenario of the orbit.
+# Exact betas answer any query, a failed threshold check only stores an
+# upper bound on beta.
+class VerificationCache():
+    def __init__(self, fullpath=None):
+        if fullpath is None:
+            if not os.path.isdir(CacheSaveDir):
+                os.makedirs(CacheSaveDir)
+            fullpath = CacheSaveDir + "/" + CacheFilename
+        self.fullpath = fullpath
+        self.conn = sqlite3.connect(fullpath)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS verification ("
+                          "key TEXT PRIMARY KEY, "
+                          "radix INTEGER, wiring TEXT, M TEXT, etmHash TEXT, "
+                          "l2fp TEXT, l1fp TEXT, linkfp TEXT, "
+                          "beta REAL, exact INTEGER, etmIndex INTEGER, "
+                          "meta TEXT, created REAL)")
+        self.conn.commit()
+        self.lastETMs = None
+        self.lastETMHash = None
+        self.lastWiring = None
+        self.lastPattern = None
+
+
+    def close(self):
+        self.conn.close()
+
+
+    def etmHash(self, etms):
+        if etms is not self.lastETMs:
+            self.lastETMs = etms
+            self.lastETMHash = hashETMs(etms)
+        return self.lastETMHash
+
+
+    def failurePattern(self, radix, wiring):
+        wiring = tuple(tuple(int(w) for w in we) for we in wiring)
+        if self.lastWiring != (radix, wiring):
+            self.lastWiring = (radix, wiring)
+            self.lastPattern = FailurePattern(radix, wiring)
+        return self.lastPattern
+
+
+    def scenarioKey(self, radix, wiring, M, etms, l2fp, l1fp, linkfp):
+        return self.scenarioKeyIDs(radix, wiring, M, etms,
+                                   [nodeID(c) for c in l2fp],
+                                   [nodeID(e) for e in l1fp],
+                                   [parseLink(l) for l in linkfp])
+
+
+    # Same key as scenarioKey for the scenario of a FailureMask
+    def maskKey(self, radix, wiring, M, etms, mask):
+        return self.scenarioKeyIDs(radix, wiring, M, etms, mask.l2s(), mask.l1s(), mask.links())
+
+
+    def scenarioKeyIDs(self, radix, wiring, M, etms, l2s, l1s, links):
+        FP = self.failurePattern(radix, wiring)
+        (l2s, l1s, links) = FP.getCanonicalScenarioIDs(l2s, l1s, links)
+        fields = { "radix": radix,
+                   "wiring": json.dumps([list(we) for we in FP.wiring]),
+                   "M": json.dumps(list(M)),
+                   "etmHash": self.etmHash(etms),
+                   "l2fp": json.dumps([coreName(c) for c in l2s]),
+                   "l1fp": json.dumps([edgeName(e) for e in l1s]),
+                   "linkfp": json.dumps([list(linkName(e, c)) for (e, c) in links]) }
+        code = json.dumps([fields[f] for f in ("radix", "wiring", "M", "etmHash", "l2fp", "l1fp", "linkfp")])
+        fields["key"] = hashlib.sha1(code.encode()).hexdigest()
+        return fields
+
+
+    # Returns the result verificationRouter would return, or None on a miss
+    def lookup(self, key, threshold=None):
+        row = self.conn.execute("SELECT beta, exact, etmIndex FROM verification WHERE key = ?",
+                                (key["key"],)).fetchone()
+        if row is None:
+            return None
+        (beta, exact, etmIndex) = row
+        if threshold is None:
+            if exact:
+                return beta
+            return None
+        # An exact beta below the threshold names no violating ETM, so it
+        # is a miss and the threshold solve fills in the index
+        if beta < threshold:
+            if etmIndex is None:
+                return None
+            return (False, etmIndex, beta)
+        if exact:
+            return (True, None, beta)
+        return None
+
+
+    def store(self, key, result, threshold=None, meta=None):
+        if threshold is None:
+            (beta, exact, etmIndex) = (result, True, None)
+        else:
+            (passed, etmIndex, beta) = result
+            exact = passed
+        if meta is None:
+            meta = dict()
+        # Keep an exact beta and only add the violating ETM to it
+        if not exact and etmIndex is not None:
+            cur = self.conn.execute("UPDATE verification SET etmIndex = ? WHERE key = ? AND exact = 1",
+                                    (etmIndex, key["key"]))
+            if cur.rowcount > 0:
+                self.conn.commit()
+                return
+        self.conn.execute("INSERT OR REPLACE INTO verification VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                          (key["key"], key["radix"], key["wiring"], key["M"], key["etmHash"],
+                           key["l2fp"], key["l1fp"], key["linkfp"],
+                           float(beta), int(exact), etmIndex, json.dumps(meta), time.time()))
+        self.conn.commit()
+
+
+def test_VerificationCache():
+    import tempfile
+    from Wiring import load_Wiring
+    from ExtremeTraffic import load_ETM
+    radix = 4
+    M = (2, 2, 4)
+    wiring = load_Wiring(M, "Optimal")
+    etms = load_ETM(M)
+    tmpdir = tempfile.mkdtemp()
+    cache = VerificationCache(tmpdir + "/" + CacheFilename)
+
+    # Swapping the L2 switches and the L1 switches of a group maps one
+    # scenario onto the other, so both hit the entry of the first
+    groups = dict()
+    for e in range(radix):
+        groups.setdefault(tuple(wiring[e]), list()).append(e)
+    (ea, eb) = [grp for grp in groups.values() if len(grp) >= 2][0][:2]
+    key = cache.scenarioKey(radix, wiring, M, etms, ["c0"], [], [linkName(ea, 1)])
+    cache.store(key, 0.75)
+    key = cache.scenarioKey(radix, wiring, M, etms, ["c1"], [], [linkName(eb, 0)])
+    assert cache.lookup(key) == 0.75
+    assert cache.lookup(key, 0.5) == (True, None, 0.75)
+    key = cache.scenarioKey(radix, wiring, M, etms, ["c1"], [], [])
+    assert cache.lookup(key) is None
+
+    # An exact beta below the threshold is a miss until a threshold solve
+    # adds the violating ETM, which keeps the exact beta
+    key = cache.scenarioKey(radix, wiring, M, etms, ["c0"], [], [linkName(eb, 1)])
+    assert cache.lookup(key, 0.8) is None
+    cache.store(key, (False, 3, 0.78), 0.8)
+    assert cache.lookup(key, 0.8) == (False, 3, 0.75)
+    assert cache.lookup(key) == 0.75
+    cache.close()
+    print("VerificationCache OK")
+
+
+if __name__ == "__main__":
+    test_VerificationCache()
@@ -1,29 +1,28 @@
 from __future__ import print_function
 import time
-import pickle
+import multiprocessing as mp
 import numpy as np
 
-import gurobipy as gp
-
-from ExtremeTraffic import load_ETM
+from Solver import getBackend, ModelBuilder
+from ExtremeTraffic import load_PrunedETM, etmInequalities, computeETM, pruneETM
+from Profiling import profiled
+from Compat import loadPickle, savePickle
 
 
 WiringSaveDir = "Wiring-save"
 
 
+@profiled("load_Wiring")
 def load_Wiring(M, algo):
     fullpath = WiringSaveDir + "/" + wiringFilename(M, algo)
-    fp = open(fullpath, "r")
-    wiring = pickle.load(fp)
-    fp.close()
+    wiring = loadPickle(fullpath)
     return wiring
 
 
+@profiled("save_Wiring")
 def save_Wiring(wiring, M, algo):
     fullpath = WiringSaveDir + "/" + wiringFilename(M, algo)
-    fp = open(fullpath, "w")
-    pickle.dump(wiring, fp)
-    fp.close()
+    savePickle(wiring, fullpath)
     print("Save result to", fullpath)    
 
 
@@ -34,20 +33,30 @@ def wiringFilename(M, algo):
     return name + "-" + algo
 
 
-def optimizeWiring(radix, M, algo):
+@profiled("optimizeWiring")
+def optimizeWiring(radix, M, algo, backend=None, etms=None):
+    if algo == "Lazy":
+        return optimizeWiringLazy(radix, M, backend, etms)
+    if algo == "LocalSearch":
+        return optimizeWiringLocalSearch(radix, M, etms)
     K = len(M)
     numEdge = radix
-    numIntf = radix/2
+    numIntf = radix // 2
 
-    etms = load_ETM(M)
+    if etms is None:
+        etms = load_PrunedETM(M, "Wiring")
+    if backend is None:
+        backend = getBackend()
 
-    model = gp.Model()
+    model = ModelBuilder()
 
-    assign = gp.tuplelist((e, k) for e in range(numEdge) for k in range(K))
-    w = model.addVars(assign, lb=0, vtype=gp.GRB.INTEGER, name="w_")
+    assign = [(e, k) for e in range(numEdge) for k in range(K)]
+    wlb = dict()
+    wub = dict()
     for (e, k) in assign:
-        w[e, k].setAttr(gp.GRB.Attr.UB, min(M[k], numIntf))
-    if algo == "Optimal":
+        wlb[e, k] = 0
+        wub[e, k] = min(M[k], numIntf)
+    if algo in ("Optimal", "OptimalSym"):
         pass
     elif algo == "Heuristic":
         print("Heuristic speedup is enable.")
@@ -56,40 +65,25 @@ def optimizeWiring(radix, M, algo):
         for etm in etms:
             utm = np.maximum(utm, etm)        
         for (e, k) in assign:
-            w[e, k].setAttr(gp.GRB.Attr.LB, np.floor(M[k]/float(numEdge)))
-            w[e, k].setAttr(gp.GRB.Attr.UB, np.ceil(M[k]/float(numEdge)))
+            wlb[e, k] = np.floor(M[k]/float(numEdge))
+            wub[e, k] = np.ceil(M[k]/float(numEdge))
     else:
         assert False, "Unknown algorithm"
-
-    aux = gp.tuplelist((i, j, e, t) for i in range(K) for j in range(K) if i != j for e in range(numEdge) for t in range(len(etms)))
-    a = model.addVars(aux, lb=0, vtype=gp.GRB.CONTINUOUS, name="a_")
-    b = model.addVar(lb=0, vtype=gp.GRB.CONTINUOUS, name="b")
-    model.update()
-
-    model.setObjective(b, gp.GRB.MINIMIZE)
-    for k in range(K):
-        model.addConstr(w.sum("*", k) == M[k], name="tcap_"+str(k))
-    for e in range(numEdge):
-        model.addConstr(w.sum(e, "*") == numIntf, name="icap_"+str(e))
-
-    for (i, j, e, t) in aux:
-        cname = "a_" + str(i) + "_" + str(j) + "_" + str(e) + "_" + str(t)
-        etm = etms[t]
-        model.addConstr(etm[i, j]*(w[e, i]/M[i] - w[e, j]/M[j]) <= a[i, j, e, t], name=cname)
-    for t in range(len(etms)):
-        model.addConstr(a.sum("*", "*", "*", t) <= b)
+    if algo == "OptimalSym":
+        (w, b) = addWiringModelSym(model, radix, M, etms, wlb, wub)
+    else:
+        (w, b) = addWiringModel(model, radix, M, etms, wlb, wub)
 
     print("Solver starts")
-    model.optimize()
+    sol = backend.createModel(model.build()).solve()
     
-    status = model.status
     wiring = list()
-    if status == gp.GRB.Status.OPTIMAL:
+    if sol.status == "Optimal":
         print("Wiring is found.")
         for e in range(numEdge):
             we = [0]*K
             for k in range(K):
-                we[k] = int(round(w[e, k].x))
+                we[k] = int(round(sol.x[w[e, k]]))
             wiring.append(we)
     else:
         print("Fail to determine wiring.")
@@ -98,10 +92,323 @@ def optimizeWiring(radix, M, algo):
     return tuple(tuple(we) for we in wiring)
 
 
+# Wiring variables w[e, k] with the port constraints and, per ETM t, the
+# auxiliaries a[i, j, e, t] >= etm[i, j] * (w[e, i]/M[i] - w[e, j]/M[j])
+# bounding the objective b.  Returns (w, b).
+def addWiringModel(model, radix, M, etms, wlb, wub):
+    K = len(M)
+    numEdge = radix
+    numIntf = radix // 2
+
+    w = dict()
+    for e in range(numEdge):
+        for k in range(K):
+            w[e, k] = model.addVar(lb=wlb[e, k], ub=wub[e, k], integer=True)
+    b = model.addVar(lb=0)
+
+    model.setObjective([b], [1])
+    for k in range(K):
+        model.addConstr([w[e, k] for e in range(numEdge)], [1]*numEdge, "=", M[k])
+    for e in range(numEdge):
+        model.addConstr([w[e, k] for k in range(K)], [1]*K, "=", numIntf)
+    for etm in etms:
+        addWiringETM(model, w, b, radix, M, etm)
+    return (w, b)
+
+
+def addWiringETM(model, w, b, radix, M, etm):
+    K = len(M)
+    numEdge = radix
+    cols = list()
+    for i in range(K):
+        for j in range(K):
+            if i == j:
+                continue
+            for e in range(numEdge):
+                a = model.addVar(lb=0)
+                model.addConstr([w[e, i], w[e, j], a],
+                                [etm[i, j]/float(M[i]), -etm[i, j]/float(M[j]), -1], "<", 0)
+                cols.append(a)
+    model.addConstr(cols + [b], [1]*len(cols) + [-1], "<", 0)
+
+
+# Largest coefficient of the row-order constraints of addWiringModelSym.
+# With integrality tolerances around 1e-5, larger coefficients let the
+# solver accept rows out of order or reject feasible ones.
+SymOrderMaxCoeff = 10**4
+
+
+# Tightened variant of addWiringModel.  Edges are interchangeable, so rows
+# of w are ordered lexicographically (non-increasing) with one constraint
+# per consecutive pair, reading a row as a number in base numIntf + 1.
+# Only the leading columns whose digits stay within SymOrderMaxCoeff are
+# read, down to ordering by the first column alone; any leading columns
+# still leave a valid ordering of the rows.
+# The auxiliaries p[i, j, e] >= w[e, i]/M[i] - w[e, j]/M[j] do not depend
+# on the ETM: as etm >= 0, sum_e p[i, j, e] is the same bound for every
+# ETM, so each ETM adds one row over those sums instead of K^2 * numEdge
+# variables and rows.  Returns (w, b).
+def addWiringModelSym(model, radix, M, etms, wlb, wub):
+    K = len(M)
+    numEdge = radix
+    numIntf = radix // 2
+
+    w = dict()
+    for e in range(numEdge):
+        for k in range(K):
+            w[e, k] = model.addVar(lb=wlb[e, k], ub=wub[e, k], integer=True)
+    b = model.addVar(lb=0)
+
+    model.setObjective([b], [1])
+    for k in range(K):
+        model.addConstr([w[e, k] for e in range(numEdge)], [1]*numEdge, "=", M[k])
+    for e in range(numEdge):
+        model.addConstr([w[e, k] for k in range(K)], [1]*K, "=", numIntf)
+
+    base = numIntf + 1
+    numDigit = 1
+    while numDigit < K and base**numDigit <= SymOrderMaxCoeff:
+        numDigit += 1
+    digits = [float(base**(numDigit-1-k)) for k in range(numDigit)]
+    for e in range(numEdge-1):
+        model.addConstr([w[e, k] for k in range(numDigit)] + [w[e+1, k] for k in range(numDigit)],
+                        digits + [-d for d in digits], ">", 0)
+
+    # q[i, j] = sum_e p[i, j, e]
+    q = dict()
+    for i in range(K):
+        for j in range(K):
+            if i == j:
+                continue
+            q[i, j] = model.addVar(lb=0)
+            cols = list()
+            for e in range(numEdge):
+                p = model.addVar(lb=0)
+                model.addConstr([w[e, i], w[e, j], p], [1/float(M[i]), -1/float(M[j]), -1], "<", 0)
+                cols.append(p)
+            model.addConstr(cols + [q[i, j]], [1]*len(cols) + [-1], "=", 0)
+
+    pairs = sorted(q.keys())
+    for etm in etms:
+        nz = [(i, j) for (i, j) in pairs if etm[i, j] != 0]
+        model.addConstr([q[i, j] for (i, j) in nz] + [b], [float(etm[i, j]) for (i, j) in nz] + [-1], "<", 0)
+    return (w, b)
+
+
+# Largest wiring objective over the whole ETM polytope for a fixed wiring.
+# With T >= 0 the objective is linear in T, sum over i != j of
+# T[i, j] * sum_e max(0, w[e][i]/M[i] - w[e][j]/M[j]), so one LP over the
+# polytope inequalities of generate_ETM finds the worst traffic matrix.
+def worstCaseETM(M, wiring, backend):
+    K = len(M)
+    coeff = pairImbalance(M, wiring)
+
+    model = ModelBuilder()
+    T = model.addVars(K*K)
+    # Rows are b + a.x >= 0, see etmInequalities
+    for row in etmInequalities(M):
+        nz = [x for x in range(K*K) if row[1+x] != 0]
+        model.addConstr([T[x] for x in nz], [row[1+x] for x in nz], ">", -row[0])
+    model.setObjective(T, coeff.ravel(), maximize=True)
+    sol = backend.createModel(model.build()).solve()
+    assert sol.status == "Optimal", sol.status
+    etm = np.array(sol.x, dtype='float64').reshape((K, K))
+    return (etm, sol.objVal)
+
+
+# imbalance[i, j] = sum_e max(0, w[e][i]/M[i] - w[e][j]/M[j]), the wire
+# share that trunk pair (i, j) has to move up through the L2 layer per unit
+# of traffic.  wiring is one wiring or a stack of them (W x numEdge x K),
+# and the result is K x K or W x K x K.
+def pairImbalance(M, wiring):
+    share = np.asarray(wiring, dtype='float64') / np.asarray(M, dtype='float64')
+    diff = share[..., :, :, None] - share[..., :, None, :]
+    return np.maximum(diff, 0).sum(axis=-3)
+
+
+# The wiring objective of optimizeWiring for every ETM at once,
+# sum over i != j of etm[i, j] * imbalance[i, j].  Returns the objective
+# per ETM (W x T for a stack of wirings) and the per trunk pair terms
+# (T x K x K, or W x T x K x K).  The wiring's score is the max over ETMs.
+def evaluateWiring(M, wiring, etms):
+    imbalance = pairImbalance(M, wiring)
+    tf = np.asarray(etms, dtype='float64')
+    terms = tf * imbalance[..., None, :, :]
+    return (terms.sum(axis=(-2, -1)), terms)
+
+
+# Max over ETMs of the objective of each wiring in a W x numEdge x K stack
+def scoreWirings(M, wirings, etms):
+    imbalance = pairImbalance(M, wirings)
+    tf = np.asarray(etms, dtype='float64')
+    return np.einsum('wij,tij->wt', imbalance, tf).max(axis=1)
+
+
+# Cutting-plane ("Lazy") variant of optimizeWiring.  The MILP starts from a
+# few ETMs, and every round adds the polytope's worst traffic matrix for
+# the current wiring until that matrix no longer beats the MILP bound.
+# Vertex enumeration is never needed, so larger K stays tractable.
+@profiled("optimizeWiringLazy")
+def optimizeWiringLazy(radix, M, backend=None, etms=None, maxIter=100, tol=1e-6):
+    K = len(M)
+    numEdge = radix
+    numIntf = radix // 2
+    if backend is None:
+        backend = getBackend()
+
+    active = list()
+    if etms is not None:
+        active.extend(etms)
+    if len(active) == 0:
+        (etm, val) = worstCaseETM(M, getBaselineWiring(radix, M), backend)
+        active.append(etm)
+
+    wlb = dict()
+    wub = dict()
+    for e in range(numEdge):
+        for k in range(K):
+            wlb[e, k] = 0
+            wub[e, k] = min(M[k], numIntf)
+
+    for it in range(maxIter):
+        model = ModelBuilder()
+        (w, b) = addWiringModel(model, radix, M, active, wlb, wub)
+        sol = backend.createModel(model.build()).solve()
+        assert sol.status == "Optimal", sol.status
+        wiring = tuple(tuple(int(round(sol.x[w[e, k]])) for k in range(K)) for e in range(numEdge))
+
+        (etm, val) = worstCaseETM(M, wiring, backend)
+        print("Iteration", it, ": ETMs", len(active), ", bound", sol.objVal, ", worst case", val)
+        if val <= sol.objVal + tol * max(1, abs(val)):
+            print("Wiring is found.")
+            return tuple(sorted(wiring))
+        active.append(etm)
+    assert False, "Cutting plane did not converge in " + str(maxIter) + " iterations"
+
+
+# imbalance of a single wiring row, see pairImbalance
+def rowImbalance(row, M):
+    share = row / M
+    return np.maximum(share[:, None] - share[None, :], 0)
+
+
+# One simulated annealing run, task = (radix, M, etms, timeLimit, seed,
+# randomStart, temp).  A move takes one wire of trunk i at edge e1 and one
+# of trunk j at edge e2 and swaps their trunks, which keeps numIntf wires
+# per edge and M[k] wires per trunk.  Only rows e1 and e2 change, so the
+# objective of every ETM is updated from those two rows.  A worse wiring is
+# accepted with probability exp(-increase / (temp * score * cooling)), and
+# the temperature cools linearly to zero at the time limit.
+# Returns (score, wiring, number of moves).
+def localSearchWiring(task):
+    (radix, M, etms, timeLimit, seed, randomStart, temp) = task
+    K = len(M)
+    numEdge = radix
+    rng = np.random.RandomState(seed)
+    Mf = np.array(M, dtype='float64')
+    tf = np.asarray(etms, dtype='float64').reshape((len(etms), K*K))
+
+    w = np.array(getBaselineWiring(radix, M), dtype=int)
+    if randomStart:
+        # Random permutation of the wire endpoints, then regroup per edge
+        trunks = np.repeat(np.arange(K), M)
+        rng.shuffle(trunks)
+        w = np.zeros((numEdge, K), dtype=int)
+        for (x, k) in enumerate(trunks):
+            w[x // (len(trunks) // numEdge), k] += 1
+
+    rows = [rowImbalance(w[e], Mf) for e in range(numEdge)]
+    obj = tf.dot(sum(rows).ravel())
+    score = obj.max()
+    best = (score, w.copy())
+    temp0 = temp * score
+
+    start = time.time()
+    numMove = 0
+    cooling = 1
+    while True:
+        if numMove % 100 == 0:
+            cooling = 1 - (time.time() - start) / timeLimit
+            if cooling <= 0:
+                break
+        numMove += 1
+        (e1, e2) = rng.choice(numEdge, 2, replace=False)
+        i = rng.choice(np.nonzero(w[e1])[0])
+        j = rng.choice(np.nonzero(w[e2])[0])
+        if i == j:
+            continue
+
+        n1 = w[e1].copy()
+        n2 = w[e2].copy()
+        n1[i] -= 1
+        n1[j] += 1
+        n2[j] -= 1
+        n2[i] += 1
+        r1 = rowImbalance(n1, Mf)
+        r2 = rowImbalance(n2, Mf)
+        newObj = obj + tf.dot((r1 + r2 - rows[e1] - rows[e2]).ravel())
+        newScore = newObj.max()
+        if newScore > score:
+            if temp0 <= 0 or rng.rand() >= np.exp(-(newScore - score) / (temp0 * cooling)):
+                continue
+
+        (w[e1], w[e2]) = (n1, n2)
+        (rows[e1], rows[e2]) = (r1, r2)
+        (obj, score) = (newObj, newScore)
+        if score < best[0]:
+            best = (score, w.copy())
+
+    # Re-score the best wiring from scratch, free of update round-off
+    wiring = tuple(sorted(tuple(int(x) for x in we) for we in best[1]))
+    return (scoreWirings(M, np.array([wiring]), etms)[0], wiring, numMove)
+
+
+# Local search ("LocalSearch") variant of optimizeWiring.  numRestart
+# annealing runs of timeLimit seconds each, from the baseline wiring and
+# from random wirings, on numWorker processes; the best wiring wins.
+@profiled("optimizeWiringLocalSearch")
+def optimizeWiringLocalSearch(radix, M, etms=None, timeLimit=10, seed=0, numRestart=1, numWorker=None, temp=0.02):
+    if etms is None:
+        etms = load_PrunedETM(M, "Wiring")
+    etms = np.asarray(etms, dtype='float64')
+    if numWorker is None:
+        numWorker = mp.cpu_count()
+
+    tasks = [(radix, M, etms, timeLimit, seed + r, r > 0, temp) for r in range(numRestart)]
+    if numRestart == 1 or numWorker == 1:
+        results = [localSearchWiring(task) for task in tasks]
+    else:
+        pool = mp.Pool(min(numWorker, numRestart))
+        try:
+            results = pool.map(localSearchWiring, tasks)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    for (score, wiring, numMove) in results:
+        print("Local search:", numMove, "moves, score", score)
+    (score, wiring, numMove) = min(results)
+    print("Wiring is found.")
+    return wiring
+
+
+# Score of a wiring against the MILP optimum, where the MILP is tractable.
+# Returns (score, optimal score, relative gap).
+def wiringGap(radix, M, wiring, etms=None, backend=None):
+    if etms is None:
+        etms = load_PrunedETM(M, "Wiring")
+    optimal = optimizeWiringLazy(radix, M, backend)
+    (score, optScore) = scoreWirings(M, np.array([wiring, optimal]), etms)
+    if optScore == 0:
+        return (score, optScore, 0.0 if score == 0 else np.inf)
+    return (score, optScore, (score - optScore) / optScore)
+
+
 def getBaselineWiring(radix, M):
     K = len(M)
     numEdge = radix
-    numIntf = radix/2
+    numIntf = radix // 2
     wiring = list()
     for e in range(numEdge):
         wiring.append([0]*K)
@@ -126,7 +433,7 @@ def getBaselineWiring(radix, M):
 
 
 def generateWiring(radix, M, algo):
-    if algo in ("Optimal", "Heuristic"):
+    if algo in ("Optimal", "OptimalSym", "Heuristic", "Lazy", "LocalSearch"):
         wiring = optimizeWiring(radix, M, algo)
     elif algo == "Baseline":
         wiring = getBaselineWiring(radix, M)
@@ -136,6 +443,73 @@ def generateWiring(radix, M, algo):
     save_Wiring(wiring, M, algo)
     
 
+def benchmark_evaluateWiring():
+    radix = 8
+    M = (3, 5, 7, 17)
+    numWiring = 1000
+
+    etms = pruneETM(computeETM(M), "Wiring")[0]
+    wirings = np.array([getBaselineWiring(radix, M)] * numWiring)
+    for w in wirings:
+        np.random.shuffle(w)
+
+    t = time.time()
+    for w in wirings:
+        evaluateWiring(M, w, etms)
+    dt = time.time() - t
+    print("evaluateWiring:", numWiring / dt, "wirings/sec")
+
+    t = time.time()
+    scoreWirings(M, wirings, etms)
+    dt = time.time() - t
+    print("scoreWirings:", numWiring / dt, "wirings/sec")
+
+
+def benchmark_LocalSearch():
+    for (radix, M) in ((4, (2, 2, 4)), (8, (3, 5, 7, 17)), (8, (4, 4, 8, 16))):
+        etms = pruneETM(computeETM(M), "Wiring")[0]
+        for timeLimit in (1, 5):
+            t = time.time()
+            wiring = optimizeWiringLocalSearch(radix, M, etms, timeLimit, numRestart=4)
+            dt = time.time() - t
+            (score, optScore, gap) = wiringGap(radix, M, wiring, etms)
+            print("Radix", radix, "M", M, "time limit", timeLimit, ": score", score, ", MILP", optScore, ", gap", gap, "in", dt, "sec.")
+
+
+# Time to optimal of the plain and the symmetry-broken MILP
+# Up to radix 8 both models are solved and should agree on the score.
+# Larger radixes are solved with OptimalSym only, whose score must be no
+# worse than LocalSearch's; at radix 64 the row-order digits would exceed
+# SymOrderMaxCoeff and only the leading columns are ordered.
+def benchmark_OptimalSym():
+    cases = ((4, (2, 2, 4)),
+             (6, (4, 4, 10)),
+             (6, (2, 6, 10)),
+             (6, (1, 2, 3, 12)),
+             (8, (3, 5, 7, 17)),
+             (8, (4, 4, 8, 16)),
+             (8, (2, 4, 6, 8, 12)),
+             (16, (13, 29, 37, 49)),
+             (32, (61, 113, 149, 189)),
+             (64, (251, 509, 547, 741)))
+    for (radix, M) in cases:
+        etms = pruneETM(computeETM(M), "Wiring")[0]
+        if radix <= 8:
+            algos = ("Optimal", "OptimalSym")
+        else:
+            algos = ("OptimalSym",)
+        for algo in algos:
+            t = time.time()
+            wiring = optimizeWiring(radix, M, algo, etms=etms)
+            dt = time.time() - t
+            score = scoreWirings(M, np.array([wiring]), etms)[0]
+            print("Radix", radix, "M", M, algo, ": score", score, "in", dt, "sec.")
+        if radix > 8:
+            lsWiring = optimizeWiringLocalSearch(radix, M, etms)
+            lsScore = scoreWirings(M, np.array([lsWiring]), etms)[0]
+            print("Radix", radix, "M", M, "LocalSearch : score", lsScore)
+
+
 if __name__ == "__main__":
     radix = 4
     M = (2, 2, 4)